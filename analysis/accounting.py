@@ -0,0 +1,276 @@
+import os
+import re
+import warnings
+import numpy as np
+import pandas as pd
+from langchain_core.prompts import MessagesPlaceholder
+import agent
+from profiling import profiled, phase
+
+# Token and cost accounting of the control and ToM agents: the prompts every chain sent are reconstructed from the logged interactions
+# (see dataset.py) and the simulated conversations (see agent.py), and their tokens counted with the tokenizer of the model
+
+# Prices (in dollars per token) of every model, those of gpt-3.5-turbo identical to /web/api/src/lib/agent.ts
+prices = {
+    'gpt-3.5-turbo': {
+        'input': 0.0005 / 1000,
+        'output': 0.0015 / 1000,
+    },
+    'gpt-4': {
+        'input': 0.03 / 1000,
+        'output': 0.06 / 1000,
+    },
+}
+
+# Tokens added by the chat format to every message, and to prime the reply, as counted by OpenAI for the gpt-3.5-turbo and gpt-4 models
+tokens_per_message = 3
+tokens_per_reply = 3
+
+# The stages of every chain, as (stage, prompt) with the stage named after its output
+chain_stages = {
+    'control': [
+        ('response', agent.control_prompt),
+    ],
+    'tom': [
+        ('questions', agent.tom_questions_prompt),
+        ('mental_state', agent.tom_mental_state_prompt),
+        ('response', agent.tom_response_prompt),
+    ],
+    'user_simulation': [
+        ('input', agent.user_simulation_prompt),
+    ],
+}
+
+# The model every chain runs on: the agents on gpt-3.5-turbo (as in the web client), and the simulated user on gpt-4 (as in simulate-conversations.ipynb)
+chain_models = {
+    'control': 'gpt-3.5-turbo',
+    'tom': 'gpt-3.5-turbo',
+    'user_simulation': 'gpt-4',
+}
+
+# The tiktoken encoding of a model, or None if tiktoken or the encoding is unavailable.
+# The encoding is downloaded once and then cached (in TIKTOKEN_CACHE_DIR, if set), after which it is available offline
+def load_encoding(model):
+    try:
+        import tiktoken
+        return tiktoken.encoding_for_model(model)
+    except (ImportError, KeyError, OSError, ValueError) as error:
+        warnings.warn(f'No tokenizer for {model} ({type(error).__name__}: {error}), token counts are approximated by agent.count_tokens')
+        return None
+
+# Token counts of texts, memoized by a hash of the text, in memory and in cache_file (per encoding), so repeated runs over large logs only tokenize new texts.
+# Without the tokenizer of the model, the counts are approximated by agent.count_tokens
+class TokenCounter:
+    def __init__(self, model='gpt-3.5-turbo', cache_file='data/token-counts/{encoding}.feather'):
+        self.model = model
+        self.encoding = load_encoding(model)
+        self.encoding_name = self.encoding.name if self.encoding is not None else 'approximate'
+        self.cache_file = cache_file.format(encoding=self.encoding_name) if cache_file is not None else None
+        self.hits = 0
+        self.misses = 0
+        self.saved = True
+
+        if self.cache_file is not None and os.path.exists(self.cache_file):
+            cache_df = pd.read_feather(self.cache_file)
+            self.counts = pd.Series(cache_df['tokens'].to_numpy(), index=cache_df['hash'].to_numpy())
+        else:
+            self.counts = pd.Series(np.zeros(0, dtype=np.int64), index=np.zeros(0, dtype=np.uint64))
+
+    def tokenize(self, texts):
+        if self.encoding is None:
+            return [agent.count_tokens(text) for text in texts]
+
+        return [len(tokens) for tokens in self.encoding.encode_batch(texts, disallowed_special=())]
+
+    # Number of tokens of every text (missing texts are empty), as an array
+    @profiled
+    def count(self, texts):
+        texts = pd.Series(texts, dtype=object).fillna('').to_numpy()
+        codes, uniques = pd.factorize(texts)
+        hashes = pd.util.hash_array(np.asarray(uniques, dtype=object))
+
+        counts = self.counts.reindex(hashes).to_numpy()
+        missing = np.isnan(counts)
+        if missing.any():
+            with phase('tokenize') as tokenize:
+                new_counts = np.array(tokenize.output(self.tokenize(list(uniques[missing]))), dtype=np.int64)
+            counts[missing] = new_counts
+            self.counts = pd.concat([self.counts, pd.Series(new_counts, index=hashes[missing])])
+            self.saved = False
+
+        self.hits += int((~missing).sum())
+        self.misses += int(missing.sum())
+        return counts.astype(np.int64)[codes]
+
+    def save(self):
+        if self.cache_file is None or self.saved:
+            return
+
+        os.makedirs(os.path.dirname(self.cache_file) or '.', exist_ok=True)
+        pd.DataFrame({'hash': self.counts.index.to_numpy(dtype=np.uint64), 'tokens': self.counts.to_numpy()}).to_feather(self.cache_file + '.tmp')
+        os.replace(self.cache_file + '.tmp', self.cache_file)
+        self.saved = True
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'encoding': self.encoding_name,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups > 0 else None,
+            'entries': len(self.counts),
+        }
+
+# A token counter per model (by default, of every model in chain_models), where models with the same encoding share a counter (and its cache file)
+def token_counters(models=None, cache_file='data/token-counts/{encoding}.feather'):
+    counters = {}
+    encoding_counters = {}
+    for model in models or sorted(set(chain_models.values())):
+        counter = TokenCounter(model, cache_file)
+        counters[model] = encoding_counters.setdefault(counter.encoding_name, counter)
+
+    return counters
+
+# Tokens of a message of a prompt for every turn, rendering the message once per distinct combination of its variables
+def message_tokens(message, turns_df, counter):
+    variables = sorted(message.input_variables)
+    if len(variables) == 0:
+        return np.full(len(turns_df), counter.count([message.format().content])[0])
+
+    values_df = turns_df[variables].fillna('')
+    codes = values_df.groupby(variables, sort=False).ngroup().to_numpy()
+    rendered = [message.format(**values).content for values in values_df.drop_duplicates().to_dict('records')]
+    return counter.count(rendered)[codes]
+
+# Prompt and completion tokens of every stage of a chain, for every turn of a DataFrame of turns sorted by turn within each conversation (identified by keys).
+# The prompt variables are read from the columns of the turns, the history of a turn consists of the inputs and responses of the previous turns of its conversation,
+# and the completion of every stage is read from the column named after the stage, unless renamed in completions.
+# Tokens are counted with the counter (of counters, per model) of the model the chain runs on (llm, by default as in chain_models)
+@profiled
+def chain_tokens(turns_df, chain, counters, keys, completions={}, llm=None):
+    llm = llm or chain_models[chain]
+    counter = counters[llm]
+    conversations = turns_df.groupby(keys, sort=False, observed=True)
+    exchange_tokens = counter.count(turns_df['input']) + counter.count(turns_df['response']) + 2 * tokens_per_message
+    history_tokens = pd.Series(exchange_tokens, index=turns_df.index).groupby([turns_df[key] for key in keys], sort=False, observed=True).cumsum().to_numpy() - exchange_tokens
+
+    stages = []
+    for stage, prompt in chain_stages[chain]:
+        with phase(stage, turns_df=turns_df):
+            prompt_tokens = np.full(len(turns_df), tokens_per_reply, dtype=np.int64)
+            for message in prompt.messages:
+                if isinstance(message, MessagesPlaceholder):
+                    if message.variable_name != 'history':
+                        raise ValueError(f'Unsupported placeholder {message.variable_name} of the {stage} prompt of {chain}')
+                    prompt_tokens += history_tokens
+                else:
+                    prompt_tokens += message_tokens(message, turns_df, counter) + tokens_per_message
+
+            stages.append(turns_df[keys + ['turn']].assign(
+                model=chain,
+                llm=llm,
+                stage=stage,
+                prompt_tokens=prompt_tokens,
+                completion_tokens=counter.count(turns_df[completions.get(stage, stage)]),
+                history_turns=conversations.cumcount().to_numpy(),
+            ))
+
+    return pd.concat(stages, ignore_index=True)
+
+# Code of every snippet
+def load_snippets(snippets, snippets_dir='../task/snippets'):
+    snippet_code = {}
+    for snippet in snippets:
+        with open(os.path.join(snippets_dir, f'{snippet}.py')) as file:
+            snippet_code[snippet] = file.read()
+
+    return snippet_code
+
+# Prompt and completion tokens of every stage of every logged interaction (e.g., of dataset.load_dataset), including the internal questions and mental state stages of ToM,
+# with the snippet of the task as code, as in the web client. Counters and models are as in chain_tokens, with the model of every chain in models
+@profiled
+def interaction_tokens(interactions_df, counters, models=chain_models, snippets_dir='../task/snippets'):
+    interactions_df = interactions_df.assign(
+        participant_ID=interactions_df['participant_ID'].astype(str),
+        task=interactions_df['task'].astype(str),
+        model=interactions_df['model'].astype(str),
+    ).sort_values(['participant_ID', 'task', 'turn'], kind='stable').reset_index(drop=True)
+
+    snippet_code = load_snippets(interactions_df['task'].unique(), snippets_dir)
+    interactions_df['code'] = interactions_df['task'].map(snippet_code)
+    interactions_df['language'] = 'python'
+
+    return pd.concat([
+        chain_tokens(chain_df, chain, counters, ['participant_ID', 'task'], llm=models[chain])
+        for chain, chain_df in interactions_df.groupby('model', sort=True)
+    ], ignore_index=True)
+
+# Prompt and completion tokens of every stage of every turn of saved simulated conversations (of agent.generate_conversation), including those of the simulated user.
+# Conversations are given as a dict from filename to (snippet, experience level) of the simulated user, where None infers the snippet from the filename
+# (see agent.conversation_snippet) or the experience level from the slug in the filename (see agent.asimulate_conversations), among experience_levels.
+# Counters and models are as in interaction_tokens
+@profiled
+def simulation_tokens(conversations, counters, models=chain_models, experience_levels=['Absolute beginner', 'Quite advanced'], snippets_dir='../task/snippets'):
+    turns = []
+    for filename, (snippet, experience_level) in conversations.items():
+        snippet = snippet or agent.conversation_snippet(filename, snippets_dir)
+        if experience_level is None:
+            slugs = {re.sub(r'[^a-z0-9]+', '-', level.lower()).strip('-'): level for level in experience_levels}
+            matches = [slug for slug in slugs if f'-{slug}-' in os.path.basename(filename)]
+            if len(matches) == 0:
+                raise ValueError(f'Unknown experience level of conversation {filename}')
+            experience_level = slugs[max(matches, key=len)]
+
+        for i, turn in enumerate(agent.load_conversation(filename)):
+            turns.append({
+                'conversation': filename,
+                'snippet': snippet,
+                'experience_level': experience_level,
+                'turn': i + 1,
+                'input': turn['input'],
+                'response': turn['response'],
+                'questions': turn['tom']['questions'],
+                'mental_state': turn['tom']['mental_state'],
+                'tom_response': turn['tom']['response'],
+            })
+
+    turns_df = pd.DataFrame(turns, columns=['conversation', 'snippet', 'experience_level', 'turn', 'input', 'response', 'questions', 'mental_state', 'tom_response'])
+    turns_df['code'] = turns_df['snippet'].map(load_snippets(turns_df['snippet'].unique(), snippets_dir))
+    turns_df['language'] = 'python'
+
+    return pd.concat([
+        chain_tokens(turns_df, 'control', counters, ['conversation'], llm=models['control']),
+        chain_tokens(turns_df, 'tom', counters, ['conversation'], completions={'response': 'tom_response'}, llm=models['tom']),
+        chain_tokens(turns_df, 'user_simulation', counters, ['conversation'], llm=models['user_simulation']),
+    ], ignore_index=True)
+
+# Cost (in dollars) of the prompt and completion tokens of every stage, at the prices of the model it ran on (llm)
+def token_costs(tokens_df):
+    unpriced = set(tokens_df['llm'].unique()) - set(prices)
+    if len(unpriced) > 0:
+        raise ValueError(f'No prices for models {sorted(unpriced)}')
+
+    return tokens_df.assign(
+        prompt_cost=tokens_df['prompt_tokens'] * tokens_df['llm'].map({llm: price['input'] for llm, price in prices.items()}),
+        completion_cost=tokens_df['completion_tokens'] * tokens_df['llm'].map({llm: price['output'] for llm, price in prices.items()}),
+        cost=lambda df: df['prompt_cost'] + df['completion_cost'],
+    )
+
+# Tokens and cost summed by the given columns, e.g., per turn (['participant_ID', 'task', 'turn', 'model']), per participant, or per model,
+# with the number of model calls and the mean cost per turn
+def summarize_costs(costs_df, by):
+    turn_keys = [column for column in ['participant_ID', 'conversation', 'task', 'turn'] if column in costs_df.columns]
+    costs_df = costs_df.assign(turn_ID=costs_df.groupby(turn_keys, observed=True).ngroup())
+
+    summary_df = costs_df.groupby(by, observed=True).agg(
+        calls=('stage', 'size'),
+        turns=('turn_ID', 'nunique'),
+        prompt_tokens=('prompt_tokens', 'sum'),
+        completion_tokens=('completion_tokens', 'sum'),
+        prompt_cost=('prompt_cost', 'sum'),
+        completion_cost=('completion_cost', 'sum'),
+        cost=('cost', 'sum'),
+    )
+    summary_df['cost_per_turn'] = summary_df['cost'] / summary_df['turns']
+
+    return summary_df
@@ -0,0 +1,985 @@
+import asyncio
+import collections
+import csv
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from langchain_core.messages import messages_from_dict, messages_to_dict
+from langchain_core.runnables import RunnablePassthrough, RunnableLambda
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.output_parsers import StrOutputParser
+
+# Identical prompts to /web/api/src/lib/agent.ts
+control_prompt = ChatPromptTemplate.from_messages([
+    ('system', '''You are a helpful assistant. The user is given a code snippet which they have to understand. Note that the user did not write the code or provide the code snippet themselves.
+        
+Code: """{language}
+{code}
+"""
+
+Produce an appropriate response to the user's input.'''),
+    MessagesPlaceholder('history'),
+    ('user', '{input}'),
+])
+
+tom_questions_prompt = ChatPromptTemplate.from_messages([
+    ('system', '''You are a helpful assistant. The user is given a code snippet which they have to understand. Note that the user did not write the code or provide the code snippet themselves.
+            
+Code: """{language}
+{code}
+"""'''),
+    MessagesPlaceholder('history'),
+    ('user', '{input}'),
+    ('user', '''Identify what aspects of the user's mental state are directly relevant to producing a response to the user's input. Phrase these aspects as open-ended questions. The questions should be different enough from each other to each provide valuable insights. Make sure the questions are about the user's mental state and are not leading.''')
+])
+
+tom_mental_state_prompt = ChatPromptTemplate.from_messages([
+    ('system', '''You are a helpful assistant. The user is given a code snippet which they have to understand. Note that the user did not write the code or provide the code snippet themselves.
+            
+Code: """{language}
+{code}
+"""'''),
+    MessagesPlaceholder('history'),
+    ('user', '{input}'),
+    ('user', '''Take the perspective of the user. Answer the following questions about the user's mental state, and explain how this mental state has led to the user's messages. Note that the user did not write the code or provide the code snippet themselves. Therefore, you cannot base your answers on the code snippet or on any code the user copies and pastes, only on the conversation history. Phrase the answers as independent statements, not as responses to the questions.
+
+Questions: """
+{questions}
+""".''')
+])
+
+tom_response_prompt = ChatPromptTemplate.from_messages([
+    ('system', '''You are a helpful assistant. The user is given a code snippet which they have to understand. Note that the user did not write the code or provide the code snippet themselves.
+            
+Code: """{language}
+{code}
+"""
+
+Produce an appropriate response to the user's input.'''),
+    MessagesPlaceholder('history'),
+    ('user', '{input}'),
+    ('user', '''You have identified the mental state of the user. Use this mental state to produce an appropriate response. Do not mention how the response is based on the user's mental state.
+                
+Mental state: """
+{mental_state}
+"""''')
+])
+
+user_simulation_prompt = ChatPromptTemplate.from_messages([
+    ('system', '''You are a helpful assistant. The user is given a code snippet which they have to understand. Note that the user did not write the code or provide the code snippet themselves.
+            
+Code: """{language}
+{code}
+"""'''),
+    MessagesPlaceholder('history'),
+    ('user', '''Produce a new question that the user might send to the assistant, by taking their perspective. Your programming experience level is '{experience_level}', but do not explicitly mention this.''')
+])
+
+# Prompts to update the mental state inferred in the previous turn, given only the last exchange and the new input, instead of re-inferring it from the full history
+tom_incremental_questions_prompt = ChatPromptTemplate.from_messages([
+    ('system', '''You are a helpful assistant. The user is given a code snippet which they have to understand. Note that the user did not write the code or provide the code snippet themselves.
+
+Code: """{language}
+{code}
+"""'''),
+    MessagesPlaceholder('last_exchange'),
+    ('user', '{input}'),
+    ('user', '''Earlier in the conversation, you identified the following mental state of the user.
+
+Mental state: """
+{previous_mental_state}
+"""
+
+Identify what aspects of the user's mental state are directly relevant to producing a response to the user's input, in particular those that may have changed since. Phrase these aspects as open-ended questions. The questions should be different enough from each other to each provide valuable insights. Make sure the questions are about the user's mental state and are not leading.''')
+])
+
+tom_incremental_mental_state_prompt = ChatPromptTemplate.from_messages([
+    ('system', '''You are a helpful assistant. The user is given a code snippet which they have to understand. Note that the user did not write the code or provide the code snippet themselves.
+
+Code: """{language}
+{code}
+"""'''),
+    MessagesPlaceholder('last_exchange'),
+    ('user', '{input}'),
+    ('user', '''Take the perspective of the user. Earlier in the conversation, you identified the mental state of the user given below. Update this mental state by answering the following questions about the user's mental state, and explain how this mental state has led to the user's messages. Note that the user did not write the code or provide the code snippet themselves. Therefore, you cannot base your answers on the code snippet or on any code the user copies and pastes, only on the conversation history and the previous mental state. Phrase the answers as independent statements, not as responses to the questions, and include the parts of the previous mental state that still hold.
+
+Previous mental state: """
+{previous_mental_state}
+"""
+
+Questions: """
+{questions}
+""".''')
+])
+
+# Flatten the conversation history into (user, ai) message pairs
+def history_messages(inputs):
+    return [message for turn in inputs['history'] for message in [('user', turn['input']), ('ai', turn['response'])]]
+
+# Approximate number of tokens of a text by counting words and punctuation, without requiring a tokenizer
+def count_tokens(text):
+    return len(token_pattern.findall(text))
+
+token_pattern = re.compile(r'\w+|[^\w\s]')
+
+# Number of tokens of the input and response of a turn, counted with token_counter (a function from a list of texts to their numbers of tokens,
+# e.g., accounting.TokenCounter(model).count to use the tokenizer of the model) if given, and approximated by count_tokens otherwise
+def turn_tokens(turn, token_counter=None):
+    texts = [turn['input'], turn['response']]
+    return int(sum(token_counter(texts) if token_counter is not None else map(count_tokens, texts)))
+
+sentence_end_pattern = re.compile(r'(?<=[.!?])\s')
+
+# Condense a turn of the conversation history to its input and the first sentence of its response, each at most max_characters long
+def condense_turn(turn, max_characters=200):
+    def shorten(text):
+        return text if len(text) <= max_characters else text[:max_characters].rstrip() + ' [...]'
+
+    response = sentence_end_pattern.split(turn['response'].strip(), maxsplit=1)
+    return {
+        **turn,
+        'input': shorten(turn['input']),
+        'response': shorten(response[0]) + (' [...]' if len(response) > 1 and len(response[0]) <= max_characters else ''),
+    }
+
+# Fit the conversation history into a budget of max_tokens: the most recent turns are kept verbatim, older turns are condensed,
+# and the oldest turns are dropped once even their condensed version does not fit. The code snippet in the system prompt is never affected.
+# Tokens are counted with token_counter if given (see turn_tokens)
+def budget_history(history, max_tokens=None, condensed_characters=200, token_counter=None):
+    if max_tokens is None:
+        return history
+
+    budgeted = []
+    tokens = 0
+    verbatim = True
+
+    for turn in reversed(history):
+        if not verbatim:
+            turn = condense_turn(turn, condensed_characters)
+
+        n_tokens = turn_tokens(turn, token_counter)
+        if verbatim and tokens + n_tokens > max_tokens:
+            verbatim = False
+            turn = condense_turn(turn, condensed_characters)
+            n_tokens = turn_tokens(turn, token_counter)
+
+        if tokens + n_tokens > max_tokens:
+            break
+
+        budgeted.append(turn)
+        tokens += n_tokens
+
+    return budgeted[::-1]
+
+# Flatten the conversation history into (user, ai) message pairs, within a budget of max_tokens if given
+def history_manager(max_tokens=None, condensed_characters=200, token_counter=None):
+    return lambda inputs: history_messages({'history': budget_history(inputs['history'], max_tokens, condensed_characters, token_counter)})
+
+# Number of history tokens sent in the control and ToM prompts of every turn of a conversation, with and without a budget of max_tokens
+def history_token_savings(history, max_tokens, condensed_characters=200, token_counter=None):
+    def tokens(turns):
+        return sum(turn_tokens(turn, token_counter) for turn in turns)
+
+    return [
+        {
+            'turn': i + 1,
+            'history_tokens': tokens(history[:i]),
+            'budgeted_history_tokens': tokens(budget_history(history[:i], max_tokens, condensed_characters, token_counter)),
+            'saved_tokens': tokens(history[:i]) - tokens(budget_history(history[:i], max_tokens, condensed_characters, token_counter)),
+        }
+        for i in range(len(history))
+    ]
+
+# The last (user, ai) message pair of the conversation history
+def last_exchange_messages(inputs):
+    return [message for turn in inputs['history'][-1:] for message in [('user', turn['input']), ('ai', turn['response'])]]
+
+# The mental state inferred by the ToM agent in the previous turn, if any
+def previous_mental_state(inputs):
+    if len(inputs['history']) > 0 and 'tom' in inputs['history'][-1]:
+        return inputs['history'][-1]['tom']['mental_state']
+
+    return inputs.get('previous_mental_state')
+
+# Use the incremental prompt when a previous mental state is available, and the full prompt otherwise (e.g., in the first turn)
+def select_prompt(prompt, incremental_prompt):
+    return RunnableLambda(lambda inputs: incremental_prompt if inputs['previous_mental_state'] is not None else prompt)
+
+# Detect rate limit errors (HTTP 429) of any model provider
+def is_rate_limit_error(error):
+    return type(error).__name__ == 'RateLimitError' or getattr(error, 'status_code', None) == 429
+
+# Wrap a model to retry calls with exponential backoff (and jitter) on rate limit errors
+def with_backoff(model, max_retries=6, backoff=1):
+    def delay(attempt):
+        return backoff * 2 ** attempt * (1 + random.random())
+
+    def invoke(messages):
+        for attempt in range(max_retries + 1):
+            try:
+                return model.invoke(messages)
+            except Exception as error:
+                if not is_rate_limit_error(error) or attempt == max_retries:
+                    raise
+            time.sleep(delay(attempt))
+
+    async def ainvoke(messages):
+        for attempt in range(max_retries + 1):
+            try:
+                return await model.ainvoke(messages)
+            except Exception as error:
+                if not is_rate_limit_error(error) or attempt == max_retries:
+                    raise
+            await asyncio.sleep(delay(attempt))
+
+    return RunnableLambda(invoke, afunc=ainvoke)
+
+# Wrap a model to stream its response, and record the wall time, time to first token and token usage of every call to a JSON lines trace file.
+# The turn the call belongs to is read from the 'trace' metadata of the invocation config
+def with_trace(model, agent, stage, trace_file):
+    def record(config, start, time_start, time_first_token, time_end, message):
+        usage = getattr(message, 'usage_metadata', None) or {}
+        trace = {
+            **config.get('metadata', {}).get('trace', {}),
+            'agent': agent,
+            'stage': stage,
+            'start': start,
+            'wall_time': time_end - time_start,
+            'time_to_first_token': time_first_token - time_start if time_first_token is not None else None,
+            'prompt_tokens': usage.get('input_tokens'),
+            'completion_tokens': usage.get('output_tokens'),
+        }
+
+        os.makedirs(os.path.dirname(trace_file) or '.', exist_ok=True)
+        with open(trace_file, 'a') as file:
+            file.write(json.dumps(trace) + '\n')
+
+    def invoke(messages, config):
+        start = time.time()
+        time_start = time.perf_counter()
+        time_first_token = None
+        message = None
+
+        for chunk in model.stream(messages):
+            if time_first_token is None:
+                time_first_token = time.perf_counter()
+            message = chunk if message is None else message + chunk
+
+        record(config, start, time_start, time_first_token, time.perf_counter(), message)
+        return message
+
+    async def ainvoke(messages, config):
+        start = time.time()
+        time_start = time.perf_counter()
+        time_first_token = None
+        message = None
+
+        async for chunk in model.astream(messages):
+            if time_first_token is None:
+                time_first_token = time.perf_counter()
+            message = chunk if message is None else message + chunk
+
+        record(config, start, time_start, time_first_token, time.perf_counter(), message)
+        return message
+
+    return RunnableLambda(invoke, afunc=ainvoke)
+
+# Persistent cache of model responses, content-addressed by a hash of the model, its temperature and the rendered messages.
+# Every response is stored as a JSON file in `directory`; the least recently used responses are evicted beyond `max_entries`.
+# Keys of which the response is being generated are tracked (for calls from threads and from asyncio tasks), so concurrent misses on a key only call the model once
+class ResponseCache:
+    def __init__(self, directory='data/llm-cache', max_entries=10000):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.async_in_flight = {}
+
+        os.makedirs(directory, exist_ok=True)
+        files = [entry for entry in os.scandir(directory) if entry.name.endswith('.json')]
+        self.entries = collections.OrderedDict(
+            (entry.name[:-len('.json')], None)
+            for entry in sorted(files, key=lambda entry: entry.stat().st_mtime)
+        )
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def key(self, model, messages):
+        content = {
+            'model': model_name(model),
+            'temperature': getattr(model, 'temperature', None),
+            'messages': messages_to_dict(messages.to_messages() if hasattr(messages, 'to_messages') else messages),
+        }
+        return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+
+        try:
+            with open(self.path(key)) as file:
+                message, = messages_from_dict(json.load(file))
+        except (OSError, ValueError):
+            self.entries.pop(key, None)
+            self.misses += 1
+            return None
+
+        # Mark as recently used, also for later sessions
+        self.entries.move_to_end(key)
+        os.utime(self.path(key))
+        self.hits += 1
+        return message
+
+    def put(self, key, message):
+        path = self.path(key)
+        with open(path + '.tmp', 'w') as file:
+            json.dump(messages_to_dict([message]), file)
+        os.replace(path + '.tmp', path)
+
+        self.entries[key] = None
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            evicted, _ = self.entries.popitem(last=False)
+            try:
+                os.remove(self.path(evicted))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'bypassed': self.bypassed,
+            'hit_rate': self.hits / lookups if lookups > 0 else None,
+            'entries': len(self.entries),
+        }
+
+# Name of the underlying model, e.g., 'gpt-3.5-turbo'
+def model_name(model):
+    return getattr(model, 'model_name', None) or getattr(model, 'model', None) or type(model).__name__
+
+# Whether a model samples its responses, in which case caching would replay a single sample
+def is_nondeterministic(model):
+    return (getattr(model, 'temperature', None) or 0) > 0
+
+# Wrap a model to look up responses in the cache before calling it, unless bypassed (e.g., for non-deterministic models).
+# `model` is the unwrapped model the cache key is based on, `call` the (traced, retried) runnable that calls it.
+# A miss on a key that is already being generated waits for that call and reads its response from the cache (or calls the model itself if that call failed)
+def with_cache(model, call, cache, bypass=False):
+    def invoke(messages, config):
+        if bypass:
+            cache.bypassed += 1
+            return call.invoke(messages, config)
+
+        key = cache.key(model, messages)
+        while True:
+            with cache.lock:
+                pending = cache.in_flight.get(key)
+                if pending is None:
+                    message = cache.get(key)
+                    if message is not None:
+                        return message
+                    pending = cache.in_flight[key] = threading.Event()
+                    break
+            pending.wait()
+
+        try:
+            message = call.invoke(messages, config)
+            with cache.lock:
+                cache.put(key, message)
+        finally:
+            with cache.lock:
+                del cache.in_flight[key]
+            pending.set()
+        return message
+
+    async def ainvoke(messages, config):
+        if bypass:
+            cache.bypassed += 1
+            return await call.ainvoke(messages, config)
+
+        key = cache.key(model, messages)
+        while True:
+            pending = cache.async_in_flight.get(key)
+            if pending is None:
+                message = cache.get(key)
+                if message is not None:
+                    return message
+                pending = cache.async_in_flight[key] = asyncio.Event()
+                break
+            await pending.wait()
+
+        try:
+            message = await call.ainvoke(messages, config)
+            cache.put(key, message)
+        finally:
+            del cache.async_in_flight[key]
+            pending.set()
+        return message
+
+    return RunnableLambda(invoke, afunc=ainvoke)
+
+# Prepare the model for a single stage of an agent, with backoff on rate limit errors, optional tracing, and an optional response cache.
+# Cache hits are neither retried nor traced; calls to non-deterministic models bypass the cache unless cache_nondeterministic is set
+def stage_model(model, agent, stage, max_retries=6, backoff=1, trace_file=None, cache=None, cache_nondeterministic=False):
+    call = model
+    if trace_file is not None:
+        call = with_trace(call, agent, stage, trace_file)
+    call = with_backoff(call, max_retries, backoff)
+
+    if cache is None:
+        return call
+
+    return with_cache(model, call, cache, bypass=is_nondeterministic(model) and not cache_nondeterministic)
+
+# The control agent, which responds given the conversation history, within a budget of history_tokens (counted with token_counter) if given
+def create_control_chain(model, history_tokens=None, token_counter=None, **options):
+    return RunnablePassthrough.assign(
+        history=history_manager(history_tokens, token_counter=token_counter)
+    ) | RunnablePassthrough.assign(
+        response=control_prompt | stage_model(model, 'control', 'response', **options) | StrOutputParser()
+    )
+
+# The ToM agent, which in incremental mode carries the mental state of the previous turn forward and updates it using only the last exchange and the new input.
+# The conversation history is kept within a budget of history_tokens (counted with token_counter) if given
+def create_tom_chain(model, incremental=False, history_tokens=None, token_counter=None, **options):
+    if incremental:
+        questions_prompt = select_prompt(tom_questions_prompt, tom_incremental_questions_prompt)
+        mental_state_prompt = select_prompt(tom_mental_state_prompt, tom_incremental_mental_state_prompt)
+    else:
+        questions_prompt = tom_questions_prompt
+        mental_state_prompt = tom_mental_state_prompt
+
+    return RunnablePassthrough.assign(
+        history=history_manager(history_tokens, token_counter=token_counter),
+        last_exchange=last_exchange_messages,
+        previous_mental_state=previous_mental_state,
+    ) | RunnablePassthrough.assign(
+        questions=questions_prompt | stage_model(model, 'tom', 'questions', **options) | StrOutputParser()
+    ) | RunnablePassthrough.assign(
+        mental_state=mental_state_prompt | stage_model(model, 'tom', 'mental_state', **options) | StrOutputParser()
+    ) | RunnablePassthrough.assign(
+        response=tom_response_prompt | stage_model(model, 'tom', 'response', **options) | StrOutputParser()
+    ) | (lambda output: {
+        'questions': output['questions'],
+        'mental_state': output['mental_state'],
+        'response': output['response']
+    })
+
+def create_user_simulation_chain(model, **options):
+    return RunnablePassthrough.assign(
+        history=history_messages
+    ) | user_simulation_prompt | stage_model(model, 'user_simulation', 'input', **options) | StrOutputParser()
+
+# Create the control and ToM agents, and the simulated user. Any LangChain chat model can be used, e.g., a FakeListChatModel to run offline.
+# Model calls are retried on rate limit errors, traced per stage to trace_file if given, and cached in the ResponseCache if given.
+# The history in the control and ToM prompts is kept within a budget of history_tokens if given, counted with token_counter if given (see turn_tokens)
+def create_agents(
+    model,
+    user_model,
+    max_retries=6,
+    backoff=1,
+    trace_file=None,
+    incremental_mental_state=False,
+    cache=None,
+    cache_nondeterministic=False,
+    history_tokens=None,
+    token_counter=None
+):
+    options = {
+        'max_retries': max_retries,
+        'backoff': backoff,
+        'trace_file': trace_file,
+        'cache': cache,
+        'cache_nondeterministic': cache_nondeterministic,
+    }
+
+    return {
+        'control': create_control_chain(model, history_tokens=history_tokens, token_counter=token_counter, **options),
+        'tom': create_tom_chain(model, incremental=incremental_mental_state, history_tokens=history_tokens, token_counter=token_counter, **options),
+        'user_simulation': create_user_simulation_chain(user_model, **options),
+    }
+
+# Load a previously (partially) generated conversation
+def load_conversation(filename):
+    if os.path.exists(filename):
+        with open(filename) as file:
+            return json.load(file)
+
+    return []
+
+# Save a generated conversation, atomically so a crash never leaves a partially written conversation
+def save_conversation(filename, history):
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    with open(filename + '.tmp', 'w') as file:
+        json.dump(history, file, indent=4)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(filename + '.tmp', filename)
+
+# Append-only log of the completed turns of a conversation that is being generated, e.g., data/simulated-conversation-novice.turns.jsonl.
+# Every turn is written as a JSON line and synced to disk, so a crash loses at most the turn in progress
+def checkpoint_filename(filename):
+    return os.path.splitext(filename)[0] + '.turns.jsonl'
+
+# The complete turns of a checkpoint log, and the size of the log up to the last complete turn. A turn torn by a crash is ignored
+def read_checkpoint(log_file):
+    turns = []
+    size = 0
+
+    if not os.path.exists(log_file):
+        return turns, size
+
+    with open(log_file, 'rb') as file:
+        for line in file:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            if record.get('turn') != len(turns) + 1:
+                break
+
+            turns.append({'input': record['input'], 'response': record['response'], 'tom': record['tom']})
+            size += len(line)
+
+    return turns, size
+
+# Load a conversation to continue: the turns of its checkpoint log, if it got further than the saved conversation
+def resume_conversation(filename):
+    history = load_conversation(filename)
+    turns, _ = read_checkpoint(checkpoint_filename(filename))
+
+    return turns if len(turns) > len(history) else history
+
+def append_turn(file, turn, history_turn):
+    file.write((json.dumps({'turn': turn, **history_turn}) + '\n').encode())
+    file.flush()
+    os.fsync(file.fileno())
+
+# Open the checkpoint log of a conversation for appending the turns after history: the log is truncated to its last complete turn,
+# or rewritten with the turns of history if it does not hold exactly these (e.g., when continuing a saved conversation)
+def open_checkpoint(filename, history):
+    log_file = checkpoint_filename(filename)
+    turns, size = read_checkpoint(log_file)
+    os.makedirs(os.path.dirname(log_file) or '.', exist_ok=True)
+
+    if turns == history:
+        file = open(log_file, 'r+b' if os.path.exists(log_file) else 'wb')
+        file.truncate(size)
+        file.seek(size)
+        return file
+
+    with open(log_file + '.tmp', 'wb') as file:
+        for i, history_turn in enumerate(history):
+            file.write((json.dumps({'turn': i + 1, **history_turn}) + '\n').encode())
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(log_file + '.tmp', log_file)
+
+    return open(log_file, 'ab')
+
+# Compact a completed conversation to its saved JSON format, and remove its checkpoint log
+def compact_checkpoint(filename, history):
+    save_conversation(filename, history)
+    os.remove(checkpoint_filename(filename))
+
+# Invocation config identifying the conversation turn in traces
+def trace_config(filename, turn):
+    return {'metadata': {'trace': {'conversation': filename, 'turn': turn}}}
+
+# Generate a conversation of n turns between the simulated user and both agents, continuing a previously saved conversation.
+# With checkpoint, every completed turn is appended to the checkpoint log of the conversation, from which an interrupted run resumes,
+# and the conversation is only saved (and the log removed) once complete
+def generate_conversation(agents, filename, experience_level, code, language, n=5, checkpoint=True):
+    history = resume_conversation(filename) if checkpoint else load_conversation(filename)
+    log = open_checkpoint(filename, history) if checkpoint else None
+
+    try:
+        while len(history) < n:
+            config = trace_config(filename, len(history) + 1)
+
+            input = agents['user_simulation'].invoke({
+                'experience_level': experience_level,
+                'code': code,
+                'language': language,
+                'history': history,
+            }, config)
+        
+            control = agents['control'].invoke({
+                'code': code,
+                'language': language,
+                'history': history,
+                'input': input
+            }, config)
+
+            tom = agents['tom'].invoke({
+                'code': code,
+                'language': language,
+                'history': history,
+                'input': input
+            }, config)
+
+            history.append({'input': input, 'response': control['response'], 'tom': tom})
+            if log is not None:
+                append_turn(log, len(history), history[-1])
+    finally:
+        if log is not None:
+            log.close()
+
+    if log is not None:
+        compact_checkpoint(filename, history)
+    else:
+        save_conversation(filename, history)
+
+    return history
+
+# Replay the inputs of a saved conversation through the ToM agent (e.g., in incremental mode), to compare the inferred mental states
+# and the size of the questions and mental state prompts with those of the saved (full recompute) conversation
+def replay_mental_states(agents, filename, code, language):
+    conversation = load_conversation(filename)
+    history = []
+    turns = []
+
+    for i, turn in enumerate(conversation):
+        inputs = {
+            'code': code,
+            'language': language,
+            'history': history,
+            'input': turn['input']
+        }
+        tom = agents['tom'].invoke(inputs, trace_config(filename, i + 1))
+
+        turns.append({
+            'turn': i + 1,
+            'input': turn['input'],
+            'mental_state': turn['tom']['mental_state'],
+            'replayed_mental_state': tom['mental_state'],
+            'prompt_characters': prompt_characters(conversation[:i], turn, incremental=False, code=code, language=language),
+            'replayed_prompt_characters': prompt_characters(history, {**turn, 'tom': tom}, incremental=True, code=code, language=language),
+        })
+
+        history.append({'input': turn['input'], 'response': turn['response'], 'tom': tom})
+
+    return turns
+
+# Number of characters sent in the questions and mental state prompts of a turn, in full recompute or incremental mode
+def prompt_characters(history, turn, incremental, code, language):
+    inputs = {
+        'code': code,
+        'language': language,
+        'history': history_messages({'history': history}),
+        'last_exchange': last_exchange_messages({'history': history}),
+        'previous_mental_state': previous_mental_state({'history': history}),
+        'input': turn['input'],
+        'questions': turn['tom']['questions'],
+    }
+    use_incremental = incremental and inputs['previous_mental_state'] is not None
+
+    return sum(
+        len(message.content)
+        for prompt in ([tom_incremental_questions_prompt, tom_incremental_mental_state_prompt] if use_incremental else [tom_questions_prompt, tom_mental_state_prompt])
+        for message in prompt.format_messages(**inputs)
+    )
+
+# Invoke a chain asynchronously within the concurrency limit
+async def ainvoke(chain, inputs, config, semaphore):
+    async with semaphore:
+        return await chain.ainvoke(inputs, config)
+
+# Generate a conversation asynchronously, where the control and ToM agents respond to each input concurrently. Checkpointed as in generate_conversation
+async def agenerate_conversation(agents, filename, experience_level, code, language, n, semaphore, checkpoint=True):
+    history = resume_conversation(filename) if checkpoint else load_conversation(filename)
+    log = open_checkpoint(filename, history) if checkpoint else None
+
+    try:
+        while len(history) < n:
+            config = trace_config(filename, len(history) + 1)
+
+            input = await ainvoke(agents['user_simulation'], {
+                'experience_level': experience_level,
+                'code': code,
+                'language': language,
+                'history': history,
+            }, config, semaphore)
+
+            inputs = {
+                'code': code,
+                'language': language,
+                'history': history,
+                'input': input
+            }
+            control, tom = await asyncio.gather(
+                ainvoke(agents['control'], inputs, config, semaphore),
+                ainvoke(agents['tom'], inputs, config, semaphore),
+            )
+
+            history.append({'input': input, 'response': control['response'], 'tom': tom})
+            if log is not None:
+                await asyncio.to_thread(append_turn, log, len(history), history[-1])
+    finally:
+        if log is not None:
+            log.close()
+
+    if log is not None:
+        compact_checkpoint(filename, history)
+    else:
+        save_conversation(filename, history)
+
+    return history
+
+# Simulate a grid of (snippet, experience_level, n_turns) conversations concurrently, with at most `concurrency` chains invoked at once.
+# Conversations are saved to `filename`, formatted with the snippet, experience level (as slug), and number of turns.
+# With checkpoint, completed turns are logged as they finish, so a rerun of an interrupted batch only generates the missing turns
+async def asimulate_conversations(
+    agents, 
+    grid, 
+    filename='data/simulated-conversations/{snippet}-{experience_level}-{n_turns}.json', 
+    concurrency=8,
+    checkpoint=True,
+):
+    semaphore = asyncio.Semaphore(concurrency)
+    conversations = []
+
+    for snippet, experience_level, n_turns in grid:
+        with open(f'../task/snippets/{snippet}.py') as file:
+            code = file.read()
+
+        conversations.append(agenerate_conversation(
+            agents,
+            filename.format(
+                snippet=snippet, 
+                experience_level=re.sub(r'[^a-z0-9]+', '-', experience_level.lower()).strip('-'), 
+                n_turns=n_turns
+            ),
+            experience_level,
+            code,
+            'python',
+            n_turns,
+            semaphore,
+            checkpoint,
+        ))
+
+    return await asyncio.gather(*conversations)
+
+# Rubric criteria on which the judge scores both responses of a turn, from 1 to 5
+judge_criteria = {
+    'correctness': 'The response is factually correct about the code snippet.',
+    'relevance': "The response addresses the user's input, without unnecessary digressions.",
+    'adaptation': "The response is adapted to the knowledge and needs of the user, as apparent from the conversation.",
+    'clarity': 'The response is clear and easy to follow.',
+}
+
+judge_prompt = ChatPromptTemplate.from_messages([
+    ('system', '''You are an expert programming tutor. The user is given a code snippet which they have to understand, and asks an assistant about it. Note that the user did not write the code or provide the code snippet themselves.
+
+Code: """{language}
+{code}
+"""
+
+You are shown the conversation so far, the user's input, and two responses A and B of the assistant to this input. Score both responses on each of the following criteria, from 1 (very poor) to 5 (excellent).
+
+Criteria: """
+{criteria}
+"""
+
+Reply with only a JSON object with the scores of both responses and a short rationale per criterion, e.g.: {example}'''),
+    MessagesPlaceholder('history'),
+    ('user', '{input}'),
+    ('user', '''Response A: """
+{response_a}
+"""
+
+Response B: """
+{response_b}
+"""'''),
+])
+
+judge_json_pattern = re.compile(r'\{.*\}', re.DOTALL)
+
+# Parse the judgement of both responses on every criterion, raising a ValueError if the judge did not reply with valid scores
+def parse_judgement(text, criteria):
+    match = judge_json_pattern.search(text)
+    if match is None:
+        raise ValueError(f'No JSON object in judgement: {text!r}')
+
+    judgement = json.loads(match.group())
+    try:
+        for criterion in criteria:
+            for response in ['A', 'B']:
+                score = judgement[criterion][response]
+                if not isinstance(score, (int, float)) or not 1 <= score <= 5:
+                    raise ValueError(f'Invalid score for {criterion} of response {response}: {score!r}')
+    except (KeyError, TypeError) as error:
+        raise ValueError(f'Incomplete judgement: {text!r}') from error
+
+    return judgement
+
+# The judge, which scores responses A and B of a turn on the given criteria
+def create_judge_chain(model, criteria=judge_criteria, **options):
+    prompt = judge_prompt.partial(
+        criteria='\n'.join(f'- {criterion}: {description}' for criterion, description in criteria.items()),
+        example=json.dumps({criterion: {'A': 4, 'B': 3, 'rationale': '...'} for criterion in list(criteria)[:1]}),
+    )
+
+    return RunnablePassthrough.assign(
+        history=history_messages
+    ) | prompt | stage_model(model, 'judge', 'scores', **options) | StrOutputParser() | (lambda text: parse_judgement(text, criteria))
+
+# A local stand-in for the judge model to run the evaluation offline, which replies with (seeded) random scores
+def judge_stand_in_model(criteria=judge_criteria, n_responses=100, seed=0):
+    from langchain_core.language_models.fake_chat_models import FakeListChatModel
+
+    rng = random.Random(seed)
+    return FakeListChatModel(responses=[
+        json.dumps({
+            criterion: {'A': rng.randint(1, 5), 'B': rng.randint(1, 5), 'rationale': 'Stand-in judgement.'}
+            for criterion in criteria
+        })
+        for _ in range(n_responses)
+    ])
+
+# Snippet of a simulated conversation, from a filename formatted as in asimulate_conversations
+def conversation_snippet(filename, snippets_dir='../task/snippets'):
+    snippets = [file[:-len('.py')] for file in os.listdir(snippets_dir) if file.endswith('.py')]
+    matches = [snippet for snippet in snippets if os.path.basename(filename).startswith(snippet + '-')]
+    if len(matches) == 0:
+        raise ValueError(f'Unknown snippet of conversation {filename}')
+
+    return max(matches, key=len)
+
+# The turns of saved conversations to judge, given as a dict from filename to snippet (None to infer the snippet from the filename)
+def load_judge_turns(conversations, snippets_dir='../task/snippets'):
+    turns = []
+
+    for filename, snippet in conversations.items():
+        snippet = snippet or conversation_snippet(filename, snippets_dir)
+        conversation = load_conversation(filename)
+
+        for i, turn in enumerate(conversation):
+            turns.append({
+                'conversation': filename,
+                'snippet': snippet,
+                'turn': i + 1,
+                'history': conversation[:i],
+                'input': turn['input'],
+                'response': turn['response'],
+                'tom': turn['tom'],
+            })
+
+    return turns
+
+# Whether the ToM response is shown to the judge as response A, which alternates (deterministically) between turns to balance position bias
+def judge_tom_first(turn):
+    return hashlib.sha256(f"{turn['conversation']}:{turn['turn']}".encode()).digest()[0] % 2 == 1
+
+# Scores of both responses of a turn, one row per criterion and model
+def judgement_rows(turn, judgement, criteria, judge):
+    positions = {'control': 'B', 'tom': 'A'} if judge_tom_first(turn) else {'control': 'A', 'tom': 'B'}
+
+    return [
+        {
+            'conversation': turn['conversation'],
+            'snippet': turn['snippet'],
+            'turn': turn['turn'],
+            'judge': judge,
+            'criterion': criterion,
+            'model': model,
+            'position': position,
+            'score': judgement[criterion][position],
+            'rationale': judgement[criterion].get('rationale'),
+        }
+        for criterion in criteria
+        for model, position in positions.items()
+    ]
+
+# Turns already scored on all criteria by the judge in the scores file
+def judged_turns(scores_file, criteria, judge):
+    if not os.path.exists(scores_file):
+        return set()
+
+    with open(scores_file, newline='') as file:
+        criteria_judged = collections.defaultdict(set)
+        for row in csv.DictReader(file):
+            if row['judge'] == judge:
+                criteria_judged[(row['conversation'], int(row['turn']))].add(row['criterion'])
+
+    return {key for key, judged in criteria_judged.items() if judged >= set(criteria)}
+
+# Score the control and ToM responses of every turn on the rubric criteria with the judge model, with at most `concurrency` calls at once.
+# Turns are judged in batches, and the scores of every batch are appended to scores_file, so an interrupted run resumes with the turns not yet judged.
+# Invalid judgements are retried up to max_attempts times, and rate limit errors are retried with backoff as in create_agents
+async def ajudge_turns(
+    model,
+    turns,
+    criteria=judge_criteria,
+    scores_file='data/judge-scores.csv',
+    batch_size=16,
+    concurrency=8,
+    max_attempts=3,
+    snippets_dir='../task/snippets',
+    **options,
+):
+    judge = model_name(model)
+    chain = create_judge_chain(model, criteria, **options)
+    semaphore = asyncio.Semaphore(concurrency)
+    codes = {}
+
+    judged = judged_turns(scores_file, criteria, judge)
+    pending = [turn for turn in turns if (turn['conversation'], turn['turn']) not in judged]
+    failed = []
+
+    async def judge_turn(turn):
+        if turn['snippet'] not in codes:
+            with open(os.path.join(snippets_dir, f"{turn['snippet']}.py")) as file:
+                codes[turn['snippet']] = file.read()
+
+        responses = [turn['tom']['response'], turn['response']] if judge_tom_first(turn) else [turn['response'], turn['tom']['response']]
+        inputs = {
+            'code': codes[turn['snippet']],
+            'language': 'python',
+            'history': turn['history'],
+            'input': turn['input'],
+            'response_a': responses[0],
+            'response_b': responses[1],
+        }
+
+        for attempt in range(max_attempts):
+            try:
+                return await ainvoke(chain, inputs, trace_config(turn['conversation'], turn['turn']), semaphore)
+            except ValueError as error:
+                if attempt == max_attempts - 1:
+                    failed.append({'conversation': turn['conversation'], 'turn': turn['turn'], 'error': str(error)})
+
+        return None
+
+    for i in range(0, len(pending), batch_size):
+        batch = pending[i:i + batch_size]
+        judgements = await asyncio.gather(*[judge_turn(turn) for turn in batch])
+
+        rows = [row for turn, judgement in zip(batch, judgements) if judgement is not None for row in judgement_rows(turn, judgement, criteria, judge)]
+        if len(rows) > 0:
+            os.makedirs(os.path.dirname(scores_file) or '.', exist_ok=True)
+            new_file = not os.path.exists(scores_file)
+            with open(scores_file, 'a', newline='') as file:
+                writer = csv.DictWriter(file, fieldnames=list(rows[0]))
+                if new_file:
+                    writer.writeheader()
+                writer.writerows(rows)
+
+    return {
+        'judged': len(pending) - len(failed),
+        'skipped': len(turns) - len(pending),
+        'failed': failed,
+    }
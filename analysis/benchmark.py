@@ -0,0 +1,403 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import util
+
+tasks = ['natural-language-processing', 'data-analysis']
+chatbots = {'natural-language-processing': 'A', 'data-analysis': 'B'}
+excel_max_rows = 1048576
+
+# Models (control/tom) per group and task, as in the study design
+def group_task_models():
+    with open('../task/design.json') as file:
+        design_config = json.load(file)
+
+    return {
+        (group, task): model
+        for group, group_config in design_config['groups'].items()
+        for stage, model in group_config['models'].items()
+        for task in design_config['stages'][stage]['tasks']
+    }
+
+# Sample codes from the codebook of the real coding data, deepened (or truncated) to code_depth levels
+def sample_codes(rng, vocabulary, n, code_depth, postfixes=None):
+    n_codes = rng.integers(1, 4, size=n)
+    codes = vocabulary[rng.integers(0, len(vocabulary), size=n_codes.sum())]
+    codes = [':'.join(code.split(':')[:code_depth]) for code in codes]
+
+    # Deeper codes get (up to 3) variants per level
+    extra_levels = code_depth - 2
+    if extra_levels > 0:
+        variants = rng.integers(1, 4, size=(len(codes), extra_levels))
+        codes = [code + ''.join(f':variant_{variant}' for variant in row) for code, row in zip(codes, variants)]
+
+    if postfixes is not None:
+        codes = [f'{code}/{postfix}' for code, postfix in zip(codes, np.repeat(postfixes, n_codes))]
+
+    offsets = np.concatenate([[0], np.cumsum(n_codes)])
+    return [', '.join(codes[start:end]) for start, end in zip(offsets[:-1], offsets[1:])]
+
+# Generate a synthetic dataset of n_participants in the format of the raw client data, the processed CSV files, and the coding workbook.
+# Texts, quiz answers and codes are sampled from the real dataset, every participant has min_turns to max_turns turns per task,
+# and codes have code_depth levels. The coding workbook is limited to the number of rows an Excel sheet can hold
+def generate_dataset(directory, n_participants, min_turns=1, max_turns=17, code_depth=2, seed=0):
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+    models = group_task_models()
+    groups = sorted({group for group, _ in models})
+
+    real_interactions_df = pd.read_csv('data/interactions.csv')
+    real_tasks_df = pd.read_csv('data/tasks.csv', dtype=str)
+    real_evaluations_df = pd.read_csv('data/evaluations.csv')
+    input_vocabulary = util.load_codes('inputs')['code'].unique()
+    feedback_vocabulary = util.load_codes('feedback', code_postfix='model')['code'].unique()
+    internal_df = real_interactions_df[~real_interactions_df['questions'].isna()]
+
+    # Participants
+    participant_IDs = np.array([f'P{i + 1}' for i in range(n_participants)], dtype=object)
+    participants_df = pd.DataFrame({
+        'participant_ID': participant_IDs,
+        'username': np.array([f'user{i + 1}' for i in range(n_participants)], dtype=object),
+        'group': np.array(groups, dtype=object)[rng.integers(0, len(groups), size=n_participants)],
+    })
+
+    # Participant tasks, with the quiz answers of a random real participant of the same task
+    tasks_df = pd.DataFrame({
+        'participant_ID': np.repeat(participant_IDs, len(tasks)),
+        'task': np.tile(np.array(tasks, dtype=object), n_participants),
+        'interaction_time': rng.integers(120, 900, size=n_participants * len(tasks)),
+        'quiz_time': rng.integers(120, 900, size=n_participants * len(tasks)),
+    })
+    answer_columns = [column for column in real_tasks_df.columns if column.startswith('Q')]
+    answers = np.empty((len(tasks_df), len(answer_columns)), dtype=object)
+    for task in tasks:
+        task_answers = real_tasks_df[real_tasks_df['task'] == task][answer_columns].to_numpy()
+        rows = np.flatnonzero(tasks_df['task'].to_numpy() == task)
+        answers[rows] = task_answers[rng.integers(0, len(task_answers), size=len(rows))]
+    tasks_df = pd.concat([tasks_df, pd.DataFrame(answers, columns=answer_columns)], axis=1)
+
+    # Interactions, with the texts of random real turns
+    n_turns = rng.integers(min_turns, max_turns + 1, size=len(tasks_df))
+    interactions_df = pd.DataFrame({
+        'participant_ID': np.repeat(tasks_df['participant_ID'].to_numpy(), n_turns),
+        'task': np.repeat(tasks_df['task'].to_numpy(), n_turns),
+        'turn': np.concatenate([np.arange(1, n + 1) for n in n_turns]) if len(n_turns) > 0 else np.array([], dtype=int),
+    })
+    interactions_df = interactions_df.merge(participants_df[['participant_ID', 'group']], on='participant_ID', how='left', sort=False)
+    interactions_df['model'] = [models[key] for key in zip(interactions_df['group'], interactions_df['task'])]
+    turns = rng.integers(0, len(real_interactions_df), size=len(interactions_df))
+    interactions_df['input'] = real_interactions_df['input'].to_numpy()[turns]
+    interactions_df['response'] = real_interactions_df['response'].to_numpy()[turns]
+    internal_turns = rng.integers(0, len(internal_df), size=len(interactions_df))
+    is_tom = interactions_df['model'].to_numpy() == 'tom'
+    interactions_df['questions'] = np.where(is_tom, internal_df['questions'].to_numpy()[internal_turns], None)
+    interactions_df['mental_state'] = np.where(is_tom, internal_df['mental_state'].to_numpy()[internal_turns], None)
+    interactions_df['response_time'] = rng.integers(500, 30000, size=len(interactions_df)) / 1000
+
+    # Evaluations, with the feedback of random real evaluations
+    evaluations_df = tasks_df[['participant_ID', 'task']].merge(participants_df[['participant_ID', 'group']], on='participant_ID', sort=False)
+    evaluations_df['chatbot'] = evaluations_df['task'].map(chatbots)
+    evaluations_df['model'] = [models[key] for key in zip(evaluations_df['group'], evaluations_df['task'])]
+    evaluations_df['feedback'] = real_evaluations_df['feedback'].to_numpy()[rng.integers(0, len(real_evaluations_df), size=len(evaluations_df))]
+
+    write_raw_client_data(os.path.join(directory, 'raw-client.json'), participants_df, tasks_df, interactions_df, rng)
+
+    participants_df[['participant_ID', 'group']].to_csv(os.path.join(directory, 'participants.csv'), index=False)
+    tasks_df.to_csv(os.path.join(directory, 'tasks.csv'), index=False)
+    interactions_df.drop(columns=['group', 'model']).to_csv(os.path.join(directory, 'interactions.csv'), index=False)
+
+    coded_interactions_df = interactions_df[:excel_max_rows - 1]
+    with pd.ExcelWriter(os.path.join(directory, 'coding.xlsx')) as writer:
+        coded_interactions_df[['participant_ID', 'task', 'turn', 'input', 'response']].assign(
+            Codes=sample_codes(rng, input_vocabulary, len(coded_interactions_df), code_depth)
+        ).to_excel(writer, sheet_name='inputs', index=False)
+        evaluations_df[['participant_ID', 'model', 'chatbot', 'feedback']].assign(
+            Codes=sample_codes(rng, feedback_vocabulary, len(evaluations_df), code_depth, evaluations_df['model'].to_numpy())
+        ).to_excel(writer, sheet_name='feedback', index=False)
+
+    return {
+        'participants': len(participants_df),
+        'tasks': len(tasks_df),
+        'interactions': len(interactions_df),
+        'coded_interactions': len(coded_interactions_df),
+    }
+
+# Write the raw client data (as dumped by /web/api/src/dump-data.ts) one participant at a time
+def write_raw_client_data(file, participants_df, tasks_df, interactions_df, rng):
+    start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+    # Step durations per participant, in the order of tasks (interaction and quiz of the first task, then of the second task, etc.)
+    durations = tasks_df.set_index(['participant_ID', 'task'])[['interaction_time', 'quiz_time']].unstack('task').swaplevel(axis=1)
+    durations = durations[[(task, column) for task in tasks for column in ['interaction_time', 'quiz_time']]]
+    durations = durations.reindex(participants_df['participant_ID']).to_numpy().tolist()
+    step_keys = [f'{type}-{task}' for task in tasks for type in ['interaction', 'quiz']]
+
+    # The interactions are ordered by participant (in the order of participants_df), find the first row of each participant
+    participant_counts = interactions_df.groupby('participant_ID', sort=False).size().reindex(participants_df['participant_ID'], fill_value=0)
+    participant_starts = np.concatenate([[0], np.cumsum(participant_counts.to_numpy())])
+
+    columns = {column: interactions_df[column].to_numpy() for column in ['task', 'model', 'input', 'response', 'questions', 'mental_state', 'response_time']}
+    time_ms = rng.integers(500, 30000, size=(len(interactions_df), 3))
+    token_counts = rng.integers(50, 2000, size=(len(interactions_df), 3, 2))
+
+    with open(file, 'w') as f:
+        f.write('[')
+
+        for i, participant in enumerate(participants_df.itertuples(index=False)):
+            steps = []
+            step_start = start
+            for key, duration in zip(step_keys, durations[i]):
+                step_end = step_start + datetime.timedelta(seconds=int(duration))
+                steps.append({
+                    'key': key,
+                    'startTime': step_start.isoformat(),
+                    'endTime': step_end.isoformat(),
+                })
+                step_start = step_end
+
+            messages = []
+            for row in range(participant_starts[i], participant_starts[i + 1]):
+                contents = [('user', columns['input'][row])]
+                if columns['model'][row] == 'tom':
+                    contents += [('internal', columns['questions'][row]), ('internal', columns['mental_state'][row])]
+                contents += [('ai', columns['response'][row])]
+
+                for j, (type, content) in enumerate(contents):
+                    is_user = type == 'user'
+                    messages.append({
+                        'task': columns['task'][row],
+                        'type': type,
+                        'content': content,
+                        'order': len(messages),
+                        'timeMS': int(columns['response_time'][row] * 1000) if is_user else int(time_ms[row, j - 1]),
+                        'tokenCountInput': None if is_user else int(token_counts[row, j - 1, 0]),
+                        'tokenCountOutput': None if is_user else int(token_counts[row, j - 1, 1]),
+                    })
+
+            f.write((',' if i > 0 else '') + json.dumps({
+                'username': participant.username,
+                'group': participant.group,
+                'steps': steps,
+                'interactionMessages': messages,
+            }))
+
+        f.write(']')
+
+# Stages of the analysis pipeline on a generated dataset, as (setup, run) pairs where setup prepares the inputs of run
+def benchmark_stages(directory):
+    input_codes_file = os.path.join(directory, 'coding.xlsx')
+    models = group_task_models()
+
+    def process_client_data():
+        with open(os.path.join(directory, 'raw-client.json')) as file:
+            client_data = json.load(file)
+        participant_ID_map = {participant['username']: f'P{i + 1}' for i, participant in enumerate(client_data)}
+        return util.process_client_data(client_data, participant_ID_map)
+
+    def load_participant_ID_map():
+        participant_ID_map = {f'user{i + 1}': f'P{i + 1}' for i in range(len(pd.read_csv(os.path.join(directory, 'participants.csv'))))}
+        return {'participant_ID_map': participant_ID_map}
+
+    def load_tasks():
+        return {'participant_tasks_df': pd.read_csv(os.path.join(directory, 'tasks.csv'), dtype=str)}
+
+    def remove_codes_cache():
+        cache_dir = os.path.join(directory, 'coding-cache')
+        if os.path.exists(cache_dir):
+            for file in os.listdir(cache_dir):
+                os.remove(os.path.join(cache_dir, file))
+            os.rmdir(cache_dir)
+        return {}
+
+    def load_codes_inputs():
+        return {'codes_df': util.load_codes('inputs', additional_columns=['task', 'turn'], file=input_codes_file)}
+
+    def warm_codes_cache():
+        load_codes_inputs()
+        return {}
+
+    def load_items_codes():
+        participants_df = pd.read_csv(os.path.join(directory, 'participants.csv'))
+        items_df = pd.read_csv(os.path.join(directory, 'interactions.csv')).merge(participants_df, on='participant_ID')
+        items_df['model'] = [models[key] for key in zip(items_df['group'], items_df['task'])]
+        return {'items_df': items_df, **load_codes_inputs()}
+
+    return {
+        'process_client_data': (lambda: {}, process_client_data),
+        'stream_client_data': (load_participant_ID_map, lambda participant_ID_map: util.load_client_data(util.stream_client_data(
+            os.path.join(directory, 'raw-client.json'), os.path.join(directory, 'client'), participant_ID_map
+        ))),
+        'check_answers': (load_tasks, lambda participant_tasks_df: util.check_answers(participant_tasks_df)),
+        'load_codes': (remove_codes_cache, load_codes_inputs),
+        'load_codes_cached': (warm_codes_cache, load_codes_inputs),
+        'codes_count': (load_items_codes, lambda items_df, codes_df: util.codes_count(
+            items_df, ['participant_ID', 'task', 'turn'], codes_df, ['model']
+        )),
+        'codes_count_participants': (load_items_codes, lambda items_df, codes_df: util.codes_count(
+            items_df, ['participant_ID', 'task', 'turn'], codes_df, ['participant_ID']
+        )),
+        'codes_latex_table': (load_items_codes, lambda items_df, codes_df: util.codes_latex_table(
+            os.path.join(directory, 'interaction_codes_approach_task.tex'),
+            items_df,
+            ['participant_ID', 'task', 'turn'],
+            codes_df,
+            [
+                {
+                    'column': 'model',
+                    'title': 'Approach',
+                    'options': [
+                        {'value': 'control', 'title': 'Control'},
+                        {'value': 'tom', 'title': 'ToM'},
+                    ]
+                },
+                {
+                    'column': 'task',
+                    'title': 'Task',
+                    'options': [
+                        {'value': 'natural-language-processing', 'title': 'Task 1'},
+                        {'value': 'data-analysis', 'title': 'Task 2'},
+                    ]
+                },
+            ]
+        )),
+    }
+
+# Time a stage over `repeat` runs, and measure its peak (Python-allocated) memory in a separate run, as tracing slows it down
+def measure(setup, run, repeat=3):
+    times = []
+    for _ in range(repeat):
+        inputs = setup()
+        time_start = time.perf_counter()
+        run(**inputs)
+        times.append(time.perf_counter() - time_start)
+
+    inputs = setup()
+    tracemalloc.start()
+    run(**inputs)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'time_min': min(times),
+        'time_median': statistics.median(times),
+        'peak_memory': peak_memory,
+    }
+
+# Identify the code and environment a benchmark was run with
+def benchmark_environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+    }
+
+# Benchmark every stage at every scale (number of participants), appending one record per stage and scale to a JSON lines file.
+# Generated datasets are kept in data_dir and only regenerated when their parameters change
+def run_benchmarks(
+    scales=[10, 100, 1000],
+    stages=None,
+    repeat=3,
+    min_turns=1,
+    max_turns=17,
+    code_depth=2,
+    seed=0,
+    data_dir='data/benchmark',
+    output_file='data/benchmarks.jsonl',
+):
+    run = {
+        'run_ID': time.strftime('%Y%m%dT%H%M%S'),
+        **benchmark_environment(),
+    }
+    records = []
+
+    for n_participants in scales:
+        directory = os.path.join(data_dir, str(n_participants))
+        parameters = {'participants': n_participants, 'min_turns': min_turns, 'max_turns': max_turns, 'code_depth': code_depth, 'seed': seed}
+        parameters_file = os.path.join(directory, 'parameters.json')
+
+        dataset = None
+        if os.path.exists(parameters_file):
+            with open(parameters_file) as file:
+                generated = json.load(file)
+            if generated['parameters'] == parameters:
+                dataset = generated['dataset']
+
+        if dataset is None:
+            dataset = generate_dataset(directory, n_participants, min_turns, max_turns, code_depth, seed)
+            with open(parameters_file, 'w') as file:
+                json.dump({'parameters': parameters, 'dataset': dataset}, file)
+
+        for stage, (setup, run_stage) in benchmark_stages(directory).items():
+            if stages is not None and stage not in stages:
+                continue
+
+            record = {
+                **run,
+                'stage': stage,
+                **parameters,
+                **{f'n_{key}': value for key, value in dataset.items() if key != 'participants'},
+                'repeat': repeat,
+                **measure(setup, run_stage, repeat),
+            }
+            records.append(record)
+
+            os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+            with open(output_file, 'a') as file:
+                file.write(json.dumps(record) + '\n')
+
+    return pd.DataFrame(records)
+
+# Load the benchmark records of all runs
+def load_benchmarks(file='data/benchmarks.jsonl'):
+    return pd.read_json(file, lines=True, dtype={'run_ID': str, 'commit': str})
+
+# Compare the median time of every stage and scale of a run to a baseline run, as the speedup (baseline time / run time)
+def compare_benchmarks(benchmarks_df, baseline_run_ID, run_ID):
+    times_df = benchmarks_df[benchmarks_df['run_ID'].isin([baseline_run_ID, run_ID])].pivot_table(
+        index=['stage', 'participants'],
+        columns='run_ID',
+        values='time_median',
+    )
+
+    return times_df[baseline_run_ID] / times_df[run_ID]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the analysis pipeline on synthetic datasets of increasing scale. Run from /analysis.')
+    parser.add_argument('--scales', type=int, nargs='+', default=[10, 100, 1000], help='numbers of participants (up to 100000)')
+    parser.add_argument('--stages', nargs='+', default=None, help='stages to benchmark (default: all)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--min-turns', type=int, default=1)
+    parser.add_argument('--max-turns', type=int, default=17)
+    parser.add_argument('--code-depth', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', default='data/benchmark')
+    parser.add_argument('--output', default='data/benchmarks.jsonl')
+    args = parser.parse_args()
+
+    benchmarks_df = run_benchmarks(
+        args.scales,
+        args.stages,
+        args.repeat,
+        args.min_turns,
+        args.max_turns,
+        args.code_depth,
+        args.seed,
+        args.data_dir,
+        args.output,
+    )
+    print(benchmarks_df.pivot_table(index='stage', columns='participants', values='time_median').round(3))
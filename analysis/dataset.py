@@ -0,0 +1,137 @@
+import functools
+import json
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import util
+
+# Columns stored as categoricals, in order of first appearance (the CSV files are sorted naturally, e.g., P1, P2, ..., P10)
+categorical_columns = ['participant_ID', 'task', 'model', 'group', 'chatbot', 'stage']
+
+# Version of the stored format, datasets built with another version are rebuilt
+format_version = 2
+
+# Create DataFrames for the design config: the tasks of every stage, and the model (control/tom) of every group and task
+def load_design(design_file='../task/design.json'):
+    with open(design_file) as file:
+        design_config = json.load(file)
+
+    stage_tasks_df = pd.DataFrame([
+        {'stage': stage, 'task': task}
+        for stage, stage_config in design_config['stages'].items()
+        for task in stage_config['tasks']
+    ])
+    group_stage_models_df = pd.DataFrame([
+        {
+            'group': group,
+            'stage': stage,
+            'model': model,
+        }
+        for group, group_config in design_config['groups'].items()
+        for stage, model in group_config['models'].items()
+    ])
+    group_task_model_df = group_stage_models_df.merge(stage_tasks_df, on='stage')[['group', 'task', 'model']]
+
+    return design_config, stage_tasks_df, group_task_model_df
+
+# Read the processed CSV files and join the group, and the model (and stage) of every task, as in the design config
+def read_tables(data_dir='data', design_file='../task/design.json'):
+    design_config, stage_tasks_df, group_task_model_df = load_design(design_file)
+
+    participants_df = pd.read_csv(os.path.join(data_dir, 'participants.csv'))
+
+    interactions_df = pd.read_csv(os.path.join(data_dir, 'interactions.csv'))
+    interactions_df = interactions_df.merge(participants_df[['participant_ID', 'group']], on=['participant_ID'])
+    interactions_df = interactions_df.merge(group_task_model_df, on=['group', 'task'])
+
+    # Quiz answers are kept as text, for grading
+    participant_tasks_df = pd.read_csv(os.path.join(data_dir, 'tasks.csv'), dtype=str)
+    participant_tasks_df['interaction_time'] = participant_tasks_df['interaction_time'].astype(int)
+    participant_tasks_df['quiz_time'] = participant_tasks_df['quiz_time'].astype(int)
+    participant_tasks_df = participant_tasks_df.merge(participants_df[['participant_ID', 'group']], on=['participant_ID'])
+    participant_tasks_df = participant_tasks_df.merge(group_task_model_df, on=['group', 'task'])
+
+    evaluations_df = pd.read_csv(os.path.join(data_dir, 'evaluations.csv'))
+    evaluations_df = evaluations_df.merge(participants_df[['participant_ID', 'group']], on='participant_ID')
+    evaluations_df['model'] = [design_config['groups'][group]['models'][chatbot] for group, chatbot in zip(evaluations_df['group'], evaluations_df['chatbot'])]
+    evaluations_df = evaluations_df.merge(stage_tasks_df, left_on='chatbot', right_on='stage')
+
+    return {
+        'participants': participants_df,
+        'interactions': interactions_df,
+        'participant_tasks': participant_tasks_df,
+        'evaluations': evaluations_df,
+    }
+
+# Build the dataset: every table is stored (joined with the design config) as an uncompressed, memory-mappable Feather file in dataset_dir,
+# with categorical IDs. The dataset is only rebuilt when the CSV files or the design config changed
+def build_dataset(data_dir='data', dataset_dir=None, design_file='../task/design.json'):
+    dataset_dir = dataset_dir or os.path.join(data_dir, 'dataset')
+    meta_file = os.path.join(dataset_dir, 'meta.json')
+    sources = [os.path.join(data_dir, f'{table}.csv') for table in ['participants', 'interactions', 'tasks', 'evaluations']] + [design_file]
+    source_mtimes = {source: os.stat(source).st_mtime_ns for source in sources}
+
+    meta = None
+    if os.path.exists(meta_file):
+        with open(meta_file) as file:
+            meta = json.load(file)
+
+    if meta is not None and meta.get('version') == format_version:
+        if meta['mtimes'] == source_mtimes:
+            return meta
+
+        # Sources that were only touched (but not changed) keep the dataset
+        if meta['hashes'] == {source: util.file_hash(source) for source in sources}:
+            meta['mtimes'] = source_mtimes
+            with open(meta_file, 'w') as file:
+                json.dump(meta, file)
+            return meta
+
+    os.makedirs(dataset_dir, exist_ok=True)
+    meta = {'version': format_version, 'mtimes': source_mtimes, 'hashes': {source: util.file_hash(source) for source in sources}, 'tables': {}}
+
+    tables = read_tables(data_dir, design_file)
+
+    # Every categorical column shares its categories across tables, so the tables keep their categorical IDs when merged
+    categories = {
+        column: pd.unique(pd.concat([table_df[column] for table_df in tables.values() if column in table_df.columns]).dropna())
+        for column in categorical_columns
+    }
+
+    for table, table_df in tables.items():
+        table_df = table_df.copy()
+        for column in categorical_columns:
+            if column in table_df.columns:
+                table_df[column] = pd.Categorical(table_df[column], categories=categories[column])
+
+        table_file = f'{table}.feather'
+        feather.write_feather(pa.Table.from_pandas(table_df, preserve_index=False), os.path.join(dataset_dir, table_file), compression='uncompressed')
+        meta['tables'][table] = table_file
+
+    with open(meta_file, 'w') as file:
+        json.dump(meta, file)
+
+    return meta
+
+# Load the dataset, (re)building it if needed. Returns a lazy loader per table, which optionally loads a subset of columns
+def load_dataset(data_dir='data', dataset_dir=None, design_file='../task/design.json'):
+    dataset_dir = dataset_dir or os.path.join(data_dir, 'dataset')
+    meta = build_dataset(data_dir, dataset_dir, design_file)
+
+    return {
+        table: functools.partial(load_table, os.path.join(dataset_dir, table_file))
+        for table, table_file in meta['tables'].items()
+    }
+
+# Load a single table, memory-mapping its file
+def load_table(table_file, columns=None):
+    table_df = feather.read_table(table_file, columns=columns, memory_map=True).to_pandas()
+
+    # Missing text values are read back as None, restore them to NaN as read_csv does
+    for column in table_df.columns[table_df.dtypes == object]:
+        if table_df[column].isna().any():
+            table_df[column] = table_df[column].where(table_df[column].notna(), np.nan)
+
+    return table_df
@@ -0,0 +1,360 @@
+import argparse
+import ast
+import concurrent.futures
+import hashlib
+import inspect
+import json
+import os
+import time
+import pandas as pd
+import util
+import dataset
+
+state_file = 'data/pipeline/state.json'
+
+# Modules the node functions call into: changing their source rebuilds every node
+code_modules = [util, dataset]
+
+# A node of the pipeline: a module-level function (run in a worker process) called with kwargs, which reads the input files and writes the output files.
+# Specs the function uses (e.g., the code categories of util.py) are passed as kwargs, so that changing them rebuilds the node
+class Node:
+    def __init__(self, name, func, inputs, outputs, **kwargs):
+        self.name = name
+        self.func = func
+        self.inputs = inputs
+        self.outputs = outputs
+        self.kwargs = kwargs
+
+    # Hash of the function code, the source of the modules it calls into, and its arguments, so that changing any of them rebuilds the node
+    def spec_hash(self):
+        sources = [inspect.getsource(self.func)] + [util.file_hash(inspect.getsourcefile(module)) for module in code_modules]
+        return hashlib.sha256(('\n'.join(sources) + json.dumps(self.kwargs, sort_keys=True, default=str)).encode()).hexdigest()
+
+# Content hash of the files of a node, None for missing files
+def files_hash(files):
+    return {file: util.file_hash(file) if os.path.exists(file) else None for file in files}
+
+# Run the code cells of a notebook (except for pip installs) in a fresh namespace, up to the first markdown cell starting with `until`
+def run_notebook(notebook, until=None):
+    with open(notebook) as file:
+        cells = json.load(file)['cells']
+
+    namespace = {}
+    for cell in cells:
+        source = ''.join(cell['source'])
+        if cell['cell_type'] == 'markdown' and until is not None and source.startswith(until):
+            break
+        if cell['cell_type'] == 'code' and not source.startswith('%'):
+            exec(compile(ast.parse(source), notebook, 'exec'), namespace)
+
+def build_dataset():
+    dataset.build_dataset()
+
+def check_answers(output_file):
+    participant_tasks_df = dataset.load_dataset()['participant_tasks']()
+    util.check_answers(participant_tasks_df).to_pickle(output_file)
+
+# Parse the coding workbook into its cache once, for all load_codes nodes
+def cache_workbook(file):
+    util.load_workbook(file)
+
+def load_codes(sheet_name, output_file, additional_columns=[], code_postfix=None):
+    util.load_codes(sheet_name, additional_columns, code_postfix).to_feather(output_file)
+
+def interaction_codes_latex_table(codes_file, output_file):
+    util.codes_latex_table(
+        output_file,
+        dataset.load_dataset()['interactions'](),
+        ['participant_ID', 'task', 'turn'],
+        pd.read_feather(codes_file),
+        [util.approach_table_group, util.task_table_group]
+    )
+
+def LLM_programming_feedback_codes_latex_table(codes_file, output_file):
+    util.codes_latex_table(
+        output_file,
+        dataset.load_dataset()['participants'](),
+        ['participant_ID'],
+        pd.read_feather(codes_file),
+    )
+
+def feedback_codes_latex_table(codes_file, output_file):
+    util.codes_latex_table(
+        output_file,
+        dataset.load_dataset()['evaluations'](),
+        ['participant_ID', 'model'],
+        pd.read_feather(codes_file),
+        [util.approach_table_group]
+    )
+
+def plot_interaction_codes_LLM_familiarity(codes_file, file, categories):
+    participants_df = dataset.load_dataset()['participants']()
+
+    util.plot_codes_bars(
+        file,
+        participants_df,
+        util.codes_count(
+            dataset.load_dataset()['interactions'](),
+            ['participant_ID', 'task', 'turn'],
+            pd.read_feather(codes_file),
+            ['participant_ID']
+        ),
+        categories=categories,
+        index_order=participants_df.sort_values('familiarity_LLM')['participant_ID'].to_list(),
+        index_labels={row['participant_ID']: f"{row['participant_ID']} ({row['familiarity_LLM']})" for _, row in participants_df.iterrows()},
+    )
+
+def plot_interaction_codes_clusters(codes_file, file, categories, group_column, clusters):
+    input_codes_df = pd.read_feather(codes_file)
+    items_df = dataset.load_dataset()['interactions']()
+    items_df['uses_hypotheses'] = items_df['participant_ID'].isin(util.participant_IDs_hypotheses(input_codes_df))
+
+    util.plot_codes_pie(
+        file,
+        util.codes_count(
+            items_df,
+            ['participant_ID', 'task', 'turn'],
+            input_codes_df,
+            [group_column]
+        ),
+        categories,
+        clusters,
+    )
+
+def plot_response_length(codes_file, output_file):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    input_codes_df = pd.read_feather(codes_file)
+    interactions_df = dataset.load_dataset()['interactions']()
+    interactions_df['input_length'] = interactions_df['input'].str.len()
+    interactions_df['response_length'] = interactions_df['response'].str.len()
+
+    interactions_hypotheses_df = input_codes_df[input_codes_df['code'] == 'question:hypothesis'].copy()
+    interactions_hypotheses_df['is_hypothesis'] = True
+    interactions_hypotheses_df = interactions_hypotheses_df[['participant_ID', 'task', 'turn', 'is_hypothesis']].merge(
+        interactions_df,
+        how='right',
+        on=['participant_ID', 'task', 'turn']
+    )
+    with pd.option_context("future.no_silent_downcasting", True):
+        interactions_hypotheses_df['is_hypothesis'] = interactions_hypotheses_df['is_hypothesis'].fillna(False).infer_objects(copy=False)
+
+    # In user-study.ipynb, the style is set by the code plots preceding this plot
+    sns.set(style='whitegrid')
+    plt.figure(figsize=(6, 3))
+    ax = sns.boxplot(x='model', hue='is_hypothesis', y='response_length', data=interactions_hypotheses_df, width=0.5, palette='tab10', showfliers=False, )
+    ax.set_xticks(['control', 'tom'])
+    ax.set_xticklabels(['Control', 'ToMMY'])
+    ax.set_ylabel('Response length')
+    ax.legend(ncol=2).set_title(None)
+    ax.legend_.texts[0].set_text('Not hypothesis')
+    ax.legend_.texts[1].set_text('Hypothesis')
+
+    ax.set_xlabel(None)
+    ax.set_ylim(0, 2000)
+    plt.savefig(output_file, bbox_inches='tight')
+    plt.close('all')
+
+def regressions(codes_file, answers_file, output_file):
+    import statsmodels.formula.api as smf
+    import statsmodels.api as sm
+
+    tables = dataset.load_dataset()
+    hypotheses = util.participant_IDs_hypotheses(pd.read_feather(codes_file))
+    performance_df = util.performance_data(tables['participant_tasks'](), tables['participants'](), pd.read_pickle(answers_file), hypotheses)
+
+    summaries = []
+
+    # Regression on quiz performance, with heteroskedasticity-robust standard errors to account for underdispersion
+    mod = smf.glm(formula=util.performance_formula, data=performance_df, family=sm.families.Poisson())
+    res = mod.fit(cov_type='HC0')
+    summaries.append(f'Dispersion: {res.pearson_chi2 / res.df_resid}\n' + res.summary().as_text())
+
+    # Regression on quiz time
+    mod = smf.glm(formula=util.quiz_time_formula, data=performance_df)
+    res = mod.fit()
+    summaries.append(res.summary().as_text())
+
+    # Regression on quiz performance, for participants with (and without) hypotheses
+    for uses_hypotheses in [True, False]:
+        mod = smf.glm(formula=util.performance_formula, data=performance_df[performance_df['uses_hypotheses'] == uses_hypotheses], family=sm.families.Poisson())
+        res = mod.fit(cov_type='HC0')
+        summaries.append(res.summary().as_text())
+
+    with open(output_file, 'w') as file:
+        file.write('\n\n'.join(summaries))
+
+# The pipeline from the raw data to the figures and tables of user-study.ipynb
+def report_nodes():
+    sources = ['data/participants.csv', 'data/interactions.csv', 'data/tasks.csv', 'data/evaluations.csv']
+    dataset_files = ['data/dataset/meta.json'] + [f'data/dataset/{table}.feather' for table in ['participants', 'interactions', 'participant_tasks', 'evaluations']]
+    quizzes = [f'../task/questions/{task}.json' for task in ['natural-language-processing', 'data-analysis']]
+    codes = {
+        'LLM_programming_other': {},
+        'LLM_programming_feedback': {},
+        'speed_feedback': {},
+        'feedback': {'code_postfix': 'model'},
+        'inputs': {'additional_columns': ['task', 'turn']},
+    }
+    code_files = {sheet_name: f'data/pipeline/codes-{sheet_name}.feather' for sheet_name in codes}
+    workbook_cache = 'data/coding-cache/meta.json'
+    plot_files = lambda file: [f'{file}_{category["code"]}.png' for category in util.interaction_code_categories]
+
+    return [
+        Node(
+            'clean', run_notebook,
+            ['clean-data.ipynb', 'util.py', 'data/raw-client.json', 'data/raw-survey-pre.csv', 'data/raw-evaluation-A.csv', 'data/raw-evaluation-B.csv']
+            + [f'data/raw-quiz-{task}.csv' for task in ['natural-language-processing', 'data-analysis']],
+            sources + ['data/interaction-traces.jsonl'],
+            notebook='clean-data.ipynb', until='# Coding',
+        ),
+        Node('dataset', build_dataset, sources + ['../task/design.json', 'dataset.py'], dataset_files),
+        Node('check_answers', check_answers, dataset_files + quizzes + ['util.py'], ['data/pipeline/answers-checked.pkl'], output_file='data/pipeline/answers-checked.pkl'),
+        Node('workbook', cache_workbook, ['data/coding.xlsx', 'util.py'], [workbook_cache], file='data/coding.xlsx'),
+        *[
+            Node(f'load_codes_{sheet_name}', load_codes, [workbook_cache, 'util.py'], [code_files[sheet_name]], sheet_name=sheet_name, output_file=code_files[sheet_name], **options)
+            for sheet_name, options in codes.items()
+        ],
+        Node(
+            'interaction_codes_table', interaction_codes_latex_table, dataset_files + [code_files['inputs'], 'util.py'], ['figures/interaction_codes_approach_task.tex'],
+            codes_file=code_files['inputs'], output_file='figures/interaction_codes_approach_task.tex',
+        ),
+        Node(
+            'LLM_programming_feedback_codes_table', LLM_programming_feedback_codes_latex_table, dataset_files + [code_files['LLM_programming_feedback'], 'util.py'], ['figures/LLM_programming_feedback_codes.tex'],
+            codes_file=code_files['LLM_programming_feedback'], output_file='figures/LLM_programming_feedback_codes.tex',
+        ),
+        Node(
+            'feedback_codes_table', feedback_codes_latex_table, dataset_files + [code_files['feedback'], 'util.py'], ['figures/feedback_codes.tex'],
+            codes_file=code_files['feedback'], output_file='figures/feedback_codes.tex',
+        ),
+        Node(
+            'interaction_codes_LLM_familiarity_plots', plot_interaction_codes_LLM_familiarity, dataset_files + [code_files['inputs'], 'util.py'], plot_files('figures/interaction_codes_LLM_familiarity'),
+            codes_file=code_files['inputs'], file='figures/interaction_codes_LLM_familiarity', categories=util.interaction_code_categories,
+        ),
+        Node(
+            'interaction_codes_hypotheses_plots', plot_interaction_codes_clusters, dataset_files + [code_files['inputs'], 'util.py'], plot_files('figures/interaction_codes_hypotheses'),
+            codes_file=code_files['inputs'], file='figures/interaction_codes_hypotheses', categories=util.interaction_code_categories, group_column='uses_hypotheses', clusters=util.hypotheses_clusters,
+        ),
+        Node(
+            'interaction_codes_model_plots', plot_interaction_codes_clusters, dataset_files + [code_files['inputs'], 'util.py'], plot_files('figures/interaction_codes_model'),
+            codes_file=code_files['inputs'], file='figures/interaction_codes_model', categories=util.interaction_code_categories, group_column='model', clusters=util.model_clusters,
+        ),
+        Node(
+            'response_length_plot', plot_response_length, dataset_files + [code_files['inputs']], ['figures/response_length_model.png'],
+            codes_file=code_files['inputs'], output_file='figures/response_length_model.png',
+        ),
+        Node(
+            'regressions', regressions, dataset_files + [code_files['inputs'], 'data/pipeline/answers-checked.pkl'], ['data/pipeline/regressions.txt'],
+            codes_file=code_files['inputs'], answers_file='data/pipeline/answers-checked.pkl', output_file='data/pipeline/regressions.txt',
+        ),
+    ]
+
+# Run a node in a worker process
+def run_node(node):
+    for output in node.outputs:
+        os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+
+    time_start = time.perf_counter()
+    node.func(**node.kwargs)
+    return time.perf_counter() - time_start
+
+# Run the pipeline, rebuilding only the nodes whose code, arguments or (content-hashed) input files changed, or whose outputs are missing or were modified,
+# and running independent nodes in parallel in up to `jobs` processes. Nodes whose inputs are not available (e.g., the raw data) are skipped.
+# Only the given targets (and the nodes they depend on) are run if given. Returns a summary with the status and time of every node
+def run_pipeline(nodes, targets=None, jobs=None, force=False, state_file=state_file):
+    producers = {output: node.name for node in nodes for output in node.outputs}
+    dependencies = {node.name: {producers[input] for input in node.inputs if input in producers} - {node.name} for node in nodes}
+    nodes = {node.name: node for node in nodes}
+
+    if targets is not None:
+        selected = set()
+        pending = list(targets)
+        while pending:
+            name = pending.pop()
+            if name not in selected:
+                selected.add(name)
+                pending.extend(dependencies[name])
+        nodes = {name: node for name, node in nodes.items() if name in selected}
+
+    state = {}
+    if os.path.exists(state_file):
+        with open(state_file) as file:
+            state = json.load(file)
+
+    def is_stale(node):
+        node_state = state.get(node.name)
+        return (
+            force
+            or node_state is None
+            or node_state['spec'] != node.spec_hash()
+            or node_state['inputs'] != files_hash(node.inputs)
+            or node_state['outputs'] != files_hash(node.outputs)
+        )
+
+    summary = {}
+    running = {}
+    time_start = time.perf_counter()
+
+    with concurrent.futures.ProcessPoolExecutor(jobs, initializer=util.use_headless_backend) as executor:
+        while len(summary) < len(nodes):
+            n_finished = len(summary)
+            for name, node in nodes.items():
+                if name in summary or name in running.values() or any(dependency not in summary for dependency in dependencies[name] if dependency in nodes):
+                    continue
+
+                if any(summary.get(dependency, {}).get('status') in ['failed', 'blocked'] for dependency in dependencies[name]):
+                    summary[name] = {'status': 'blocked', 'time': None}
+                elif any(not os.path.exists(input) for input in node.inputs):
+                    # Nodes without their inputs (e.g., the unpublished raw data) keep their outputs as they are
+                    summary[name] = {'status': 'missing inputs', 'time': None}
+                elif not is_stale(node):
+                    summary[name] = {'status': 'up to date', 'time': None}
+                else:
+                    running[executor.submit(run_node, node)] = name
+
+            if len(running) == 0:
+                # Nothing could be scheduled, nor will be once running nodes finish, e.g., due to a dependency cycle
+                if len(summary) == n_finished:
+                    raise RuntimeError(f'Cannot schedule the nodes {sorted(set(nodes) - set(summary))}, their dependencies form a cycle')
+                continue
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                node = nodes[name]
+
+                try:
+                    node_time = future.result()
+                except Exception as error:
+                    summary[name] = {'status': 'failed', 'time': None, 'error': repr(error)}
+                    continue
+
+                summary[name] = {'status': 'built', 'time': node_time}
+                state[name] = {
+                    'spec': node.spec_hash(),
+                    'inputs': files_hash(node.inputs),
+                    'outputs': files_hash(node.outputs),
+                }
+
+                os.makedirs(os.path.dirname(state_file) or '.', exist_ok=True)
+                with open(state_file, 'w') as file:
+                    json.dump(state, file, indent=4)
+
+    summary_df = pd.DataFrame.from_dict(summary, orient='index').reindex(list(nodes))
+    summary_df.index.name = 'node'
+    summary_df['time'] = summary_df['time'].astype(float)
+    summary_df.attrs['wall_time'] = time.perf_counter() - time_start
+
+    return summary_df
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rebuild the stale figures and tables of the user study. Run from /analysis.')
+    parser.add_argument('targets', nargs='*', help='nodes to build (default: all)')
+    parser.add_argument('--jobs', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--force', action='store_true', help='rebuild all nodes')
+    args = parser.parse_args()
+
+    summary_df = run_pipeline(report_nodes(), args.targets or None, args.jobs, args.force)
+    print(summary_df.to_string())
+    print(f"Total wall time: {summary_df.attrs['wall_time']:.2f}s")
@@ -0,0 +1,209 @@
+import atexit
+import contextlib
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+import tracemalloc
+import pandas as pd
+
+# Opt-in profiling of the analysis functions (see util.py): enabled for a block of code with `with profiling.profile('trace.json'):`,
+# or for a whole run by setting the ANALYSIS_PROFILE environment variable to the trace file, e.g., `ANALYSIS_PROFILE=data/profile.json python pipeline.py`.
+# Only the profiling process is recorded, not its worker processes (e.g., of util.render_figures).
+# Tracing memory (with tracemalloc) slows down allocation-heavy code considerably (e.g., codes_count about 3x), which inflates the recorded wall times
+# unevenly, so the slowest phases may be the ones that allocate most. Disable it to measure times, with `profile(memory=False)` or ANALYSIS_PROFILE_MEMORY=0
+environment_variable = 'ANALYSIS_PROFILE'
+memory_environment_variable = 'ANALYSIS_PROFILE_MEMORY'
+
+# The active profiler, if any
+profiler = None
+
+# Shape of a DataFrame, Series or array, None for other values
+def shape(value):
+    value_shape = getattr(value, 'shape', None)
+    return list(value_shape) if isinstance(value_shape, tuple) else None
+
+# Records the wall time, peak memory delta (if tracing memory), and input and output shapes of every profiled function call and phase
+class Profiler:
+    def __init__(self, memory=True):
+        self.memory = memory
+        self.events = []
+        self.stack = []
+        self.time_start = time.perf_counter()
+        self.started_tracemalloc = memory and not tracemalloc.is_tracing()
+
+        if self.started_tracemalloc:
+            tracemalloc.start()
+
+    def stop(self):
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+            self.started_tracemalloc = False
+
+    def enter(self, name, inputs=None):
+        event = {
+            'name': name,
+            'path': '/'.join([parent['name'] for parent in self.stack] + [name]),
+            'inputs': inputs or {},
+            'output': None,
+            'children_time': 0,
+        }
+
+        if self.memory:
+            # The peak is reset for every phase, so the peak of the parent up to here is kept
+            current, peak = tracemalloc.get_traced_memory()
+            if len(self.stack) > 0:
+                self.stack[-1]['peak_memory'] = max(self.stack[-1]['peak_memory'], peak)
+            tracemalloc.reset_peak()
+            event['start_memory'] = current
+            event['peak_memory'] = current
+
+        self.stack.append(event)
+        event['start'] = time.perf_counter()
+        return event
+
+    def exit(self, event):
+        time_end = time.perf_counter()
+        self.stack.pop()
+
+        event['wall_time'] = time_end - event['start']
+        event['self_time'] = event['wall_time'] - event.pop('children_time')
+        if len(self.stack) > 0:
+            self.stack[-1]['children_time'] += event['wall_time']
+
+        if self.memory:
+            peak = max(event.pop('peak_memory'), tracemalloc.get_traced_memory()[1])
+            event['memory_delta'] = peak - event.pop('start_memory')
+            if len(self.stack) > 0:
+                self.stack[-1]['peak_memory'] = max(self.stack[-1]['peak_memory'], peak)
+
+        self.events.append(event)
+
+    # The events in the Chrome trace event format, which can be opened in Perfetto, chrome://tracing or speedscope (as a flame graph)
+    def trace(self):
+        pid = os.getpid()
+        tid = threading.get_ident()
+
+        return {
+            'traceEvents': [
+                {
+                    'name': event['name'],
+                    'ph': 'X',
+                    'ts': (event['start'] - self.time_start) * 1e6,
+                    'dur': event['wall_time'] * 1e6,
+                    'pid': pid,
+                    'tid': tid,
+                    'args': {
+                        'path': event['path'],
+                        'memory_delta': event.get('memory_delta'),
+                        'inputs': event['inputs'],
+                        'output': event['output'],
+                    },
+                }
+                for event in sorted(self.events, key=lambda event: event['start'])
+            ],
+            'displayTimeUnit': 'ms',
+        }
+
+    def write_trace(self, file):
+        os.makedirs(os.path.dirname(file) or '.', exist_ok=True)
+        with open(file, 'w') as f:
+            json.dump(self.trace(), f)
+
+    # Time and peak memory delta per function and phase (by its path of enclosing calls), the slowest first
+    def summary(self):
+        events_df = pd.DataFrame(self.events, columns=['path', 'wall_time', 'self_time', 'memory_delta'])
+        summary_df = events_df.groupby('path').agg(
+            calls=('wall_time', 'size'),
+            total_time=('wall_time', 'sum'),
+            self_time=('self_time', 'sum'),
+            mean_time=('wall_time', 'mean'),
+            max_time=('wall_time', 'max'),
+            max_memory_delta=('memory_delta', 'max'),
+        )
+
+        return summary_df.sort_values('total_time', ascending=False)
+
+# A phase of a profiled function, whose output shape can be recorded with output()
+class Phase:
+    def __init__(self, profiler, name, inputs):
+        self.profiler = profiler
+        self.name = name
+        self.inputs = inputs
+
+    def __enter__(self):
+        self.event = self.profiler.enter(self.name, self.inputs)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.exit(self.event)
+
+    def output(self, value):
+        self.event['output'] = shape(value)
+        return value
+
+# Stand-in for phases when profiling is disabled, which does nothing
+class DisabledPhase:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def output(self, value):
+        return value
+
+disabled_phase = DisabledPhase()
+
+# Profile an inner phase of a function, e.g., `with profiling.phase('merge', items_df=items_df) as merge: ...`, recording the shapes of the given inputs
+def phase(name, **inputs):
+    if profiler is None:
+        return disabled_phase
+
+    return Phase(profiler, name, {input: shape(value) for input, value in inputs.items()})
+
+# Profile every call of a function, recording the shapes of its DataFrame (or Series or array) arguments and return value.
+# When profiling is disabled, the only overhead is a check of the active profiler
+def profiled(func):
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if profiler is None:
+            return func(*args, **kwargs)
+
+        arguments = signature.bind_partial(*args, **kwargs).arguments
+        inputs = {argument: shape(value) for argument, value in arguments.items() if shape(value) is not None}
+
+        with Phase(profiler, func.__name__, inputs) as call:
+            return call.output(func(*args, **kwargs))
+
+    return wrapper
+
+# Enable profiling within the block, optionally writing the trace to trace_file afterwards. Yields the profiler, e.g., for its summary()
+@contextlib.contextmanager
+def profile(trace_file=None, memory=True):
+    global profiler
+
+    previous_profiler = profiler
+    profiler = Profiler(memory)
+
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        if trace_file is not None:
+            profiler.write_trace(trace_file)
+        profiler = previous_profiler
+
+# Profile the whole run if the environment variable is set, and write the trace and print the slowest phases at exit
+if os.environ.get(environment_variable):
+    profiler = Profiler(memory=os.environ.get(memory_environment_variable, '1') != '0')
+
+    @atexit.register
+    def write_profile():
+        profiler.stop()
+        profiler.write_trace(os.environ[environment_variable])
+        print(profiler.summary().head(20).to_string())
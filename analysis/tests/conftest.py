@@ -0,0 +1,11 @@
+import os
+import sys
+import pytest
+
+# The analysis modules import each other as top-level modules, and read the task files relative to the analysis directory
+analysis_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, analysis_dir)
+
+@pytest.fixture(autouse=True)
+def analysis_cwd(monkeypatch):
+    monkeypatch.chdir(analysis_dir)
@@ -0,0 +1,49 @@
+import asyncio
+import concurrent.futures
+import threading
+import time
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.runnables import RunnableLambda
+import agent
+
+# A model call that takes a while to respond, counting its calls
+def slow_call(calls):
+    lock = threading.Lock()
+
+    def invoke(messages):
+        with lock:
+            calls.append(messages)
+        time.sleep(0.1)
+        return AIMessage(content='response')
+
+    async def ainvoke(messages):
+        calls.append(messages)
+        await asyncio.sleep(0.1)
+        return AIMessage(content='response')
+
+    return RunnableLambda(invoke, afunc=ainvoke)
+
+def test_with_cache_concurrent_misses_call_once(tmp_path):
+    calls = []
+    cached = agent.with_cache(FakeListChatModel(responses=['response']), slow_call(calls), agent.ResponseCache(str(tmp_path)))
+    messages = [HumanMessage(content='input')]
+
+    with concurrent.futures.ThreadPoolExecutor(2) as executor:
+        responses = list(executor.map(cached.invoke, [messages, messages]))
+
+    assert len(calls) == 1
+    assert [response.content for response in responses] == ['response', 'response']
+
+def test_with_cache_concurrent_async_misses_call_once(tmp_path):
+    calls = []
+    cached = agent.with_cache(FakeListChatModel(responses=['response']), slow_call(calls), agent.ResponseCache(str(tmp_path)))
+    messages = [HumanMessage(content='input')]
+
+    async def run():
+        return await asyncio.gather(cached.ainvoke(messages), cached.ainvoke(messages))
+
+    responses = asyncio.run(run())
+
+    assert len(calls) == 1
+    assert [response.content for response in responses] == ['response', 'response']
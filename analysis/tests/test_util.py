@@ -0,0 +1,54 @@
+import json
+import pandas as pd
+import pytest
+import util
+
+def read_tasks():
+    return pd.read_csv('data/tasks.csv', dtype=str)
+
+# A first run without any rows stores an empty result, which a later run with rows must still merge with
+def test_check_answers_cached_empty_then_non_empty(tmp_path):
+    participant_tasks_df = read_tasks()
+    store_file = str(tmp_path / 'answers-checked.pkl')
+
+    assert util.check_answers_cached(participant_tasks_df.iloc[:0], store_file).empty
+
+    answers_df = util.check_answers_cached(participant_tasks_df, store_file)
+    pd.testing.assert_frame_equal(answers_df, util.check_answers(participant_tasks_df), check_dtype=False)
+
+# Duplicate stored rows must not duplicate the answers of unchanged rows
+def test_check_answers_cached_duplicate_store_rows(tmp_path):
+    participant_tasks_df = read_tasks()
+    store_file = str(tmp_path / 'answers-checked.pkl')
+    util.check_answers_cached(participant_tasks_df, store_file)
+
+    store = pd.read_pickle(store_file)
+    store['rows'] = pd.concat([store['rows'], store['rows']], ignore_index=True)
+    store['fingerprint'] = None
+    pd.to_pickle(store, store_file)
+
+    answers_df = util.check_answers_cached(participant_tasks_df, store_file)
+    pd.testing.assert_frame_equal(answers_df, util.check_answers(participant_tasks_df), check_dtype=False)
+
+def write_json(tmp_path, text):
+    file = tmp_path / 'array.json'
+    file.write_text(text)
+    return str(file)
+
+# Numbers (and other elements) split across chunks, down to a single character per chunk, are decoded whole
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 2 ** 20])
+def test_iter_json_array_chunk_boundaries(tmp_path, chunk_size):
+    elements = [1234, -56.75, 1e-3, 12.5e+10, 0, {'a': [1, 22, 333]}, 'text', True, None, [], 98765]
+    file = write_json(tmp_path, ' [ ' + ' ,\n'.join(json.dumps(element) for element in elements) + ' ] ')
+
+    assert list(util.iter_json_array(file, chunk_size)) == elements
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 2 ** 20])
+def test_iter_json_array_empty(tmp_path, chunk_size):
+    assert list(util.iter_json_array(write_json(tmp_path, ' [ ] '), chunk_size)) == []
+
+@pytest.mark.parametrize('text', ['[1 2]', '[1,,2]', '[,1]', '[1,]', '[1', '[1,', '{"a": 1}'])
+@pytest.mark.parametrize('chunk_size', [1, 2 ** 20])
+def test_iter_json_array_malformed(tmp_path, text, chunk_size):
+    with pytest.raises(ValueError):
+        list(util.iter_json_array(write_json(tmp_path, text), chunk_size))
@@ -1,129 +1,478 @@
 import pandas as pd
+import numpy as np
 import json
+import os
+import re
+import functools
+import itertools
+import hashlib
+import heapq
+import warnings
+import concurrent.futures
+import matplotlib
 import matplotlib.pyplot as plt
 import seaborn as sns
 import scipy.stats as stats
+from PIL import Image
+from profiling import profiled, phase
+
+line_number_suffix_pattern = re.compile(r'\.0*$')
+client_interaction_columns = ['participant_ID', 'task', 'turn', 'input', 'response', 'questions', 'mental_state', 'response_time']
+client_interaction_trace_columns = ['participant_ID', 'task', 'turn', 'stage', 'wall_time', 'time_to_first_token', 'prompt_tokens', 'completion_tokens']
+json_whitespace_pattern = re.compile(r'[ \t\n\r]*')
+json_number_continuation_pattern = re.compile(r'[0-9.eE+-]*')
+
+# Compile a quiz into a reusable answer key (parsed options, line sets, compiled regexes, normalized text sets)
+@profiled
+def compile_quiz(task):
+    path = f'../task/questions/{task}.json'
+    return _compile_quiz(path, os.stat(path).st_mtime_ns)
+
+@functools.lru_cache(maxsize=None)
+def _compile_quiz(path, mtime):
+    with open(path) as file:
+        quiz = json.load(file)
+
+    answer_key = []
+
+    for i, question in enumerate(quiz):
+        question_nr = i + 1
+        answer_column = f'Q{question_nr}'
+
+        key = {
+            'question_nr': question_nr,
+            'dimension': question['dimension'],
+            'level': question['level'],
+            'type': question['type'],
+            'columns': [answer_column],
+        }
+
+        if question['type'] == 'multiple_choice':
+            key['answer'] = question['options'][question['answer']]
+
+        elif question['type'] == 'line':
+            key['answer'] = list(question['answer'])
+
+        elif question['type'] == 'block':
+            key['columns'] = [f'{answer_column}_1', f'{answer_column}_2']
+            key['answer'] = {tuple(answer) for answer in question['answer']}
+
+        elif question['type'] in ['text', 'regex']:
+            if 'multiple' in question and question['multiple']:
+                key['columns'] = [f'{answer_column}_{i + 1}' for i in range(len(question['answer']))]
+                key['multiple'] = True
+                correct_answers = question['answer']
+            else:
+                key['multiple'] = False
+                correct_answers = [question['answer']]
+
+            if question['type'] == 'text':
+                key['answer'] = [
+                    {str(answer).lower() for answer in ([correct_answer] if isinstance(correct_answer, str) else correct_answer)}
+                    for correct_answer in correct_answers
+                ]
+            else:
+                key['answer'] = [re.compile(str(correct_answer), re.IGNORECASE) for correct_answer in correct_answers]
+
+        answer_key.append(key)
+
+    return answer_key
+
+# Parse line number answers, which may have been stored as floats (e.g., '12.0'), as text or as numbers
+@profiled
+def parse_line_numbers(answers):
+    return answers.astype(str).str.replace(line_number_suffix_pattern, '', regex=True).astype(int).to_numpy()
+
+# Grade all answers to a single compiled question, returns the correctness and the (parsed) answers
+@profiled
+def grade_question(answers_df, key):
+    if key['type'] == 'multiple_choice':
+        answers = answers_df[key['columns'][0]].to_numpy()
+        return answers == key['answer'], answers
+
+    if key['type'] == 'line':
+        answers = parse_line_numbers(answers_df[key['columns'][0]])
+        return np.isin(answers, key['answer']), answers
+
+    if key['type'] == 'block':
+        starts = parse_line_numbers(answers_df[key['columns'][0]])
+        ends = parse_line_numbers(answers_df[key['columns'][1]])
+        correct = np.fromiter((block in key['answer'] for block in zip(starts.tolist(), ends.tolist())), dtype=bool, count=len(starts))
+        answers = np.empty(len(starts), dtype=object)
+        answers[:] = [[start, end] for start, end in zip(starts, ends)]
+        return correct, answers
+
+    if key['type'] in ['text', 'regex']:
+        fields = [answers_df[column].astype(str).str.strip().str.lower().to_numpy() for column in key['columns']]
+        correct = np.ones(len(answers_df), dtype=bool)
+
+        for field, correct_answer in zip(fields, key['answer']):
+            if key['type'] == 'text':
+                correct &= np.fromiter((value in correct_answer for value in field), dtype=bool, count=len(field))
+            else:
+                correct &= np.fromiter((correct_answer.match(value) is not None for value in field), dtype=bool, count=len(field))
+
+        if key['multiple']:
+            answers = np.empty(len(answers_df), dtype=object)
+            answers[:] = [list(values) for values in zip(*fields)]
+        else:
+            answers = fields[0]
+
+        return correct, answers
+
+    # Question types without automatic grading are marked incorrect
+    columns = [column for column in key['columns'] if column in answers_df.columns]
+    answers = answers_df[columns[0]].to_numpy() if columns else np.full(len(answers_df), None, dtype=object)
+    return np.zeros(len(answers_df), dtype=bool), answers
 
 # Check quiz answers
+@profiled
 def check_answers(participant_tasks_df):
-    answers_checked_df = pd.DataFrame()
+    columns = {
+        'index': [],
+        'participant_ID': [],
+        'task': [],
+        'question_nr': [],
+        'dimension': [],
+        'level': [],
+        'correct': [],
+        'answer': [],
+    }
 
-    # Check every quiz one by one
+    # Check every quiz one by one, grading each question for all participants at once
     for task in participant_tasks_df['task'].unique():
-        with open(f'../task/questions/{task}.json') as file:
-            quiz = json.load(file)
-
         answers_df = participant_tasks_df[participant_tasks_df['task'] == task]
+        n = len(answers_df)
+
+        for key in compile_quiz(task):
+            correct, answers = grade_question(answers_df, key)
+
+            columns['index'].append(answers_df.index.to_numpy())
+            columns['participant_ID'].append(answers_df['participant_ID'].to_numpy())
+            columns['task'].append(answers_df['task'].to_numpy())
+            columns['question_nr'].append(np.full(n, key['question_nr'], dtype=np.int64))
+            columns['dimension'].append(np.full(n, key['dimension'], dtype=object))
+            columns['level'].append(np.full(n, key['level'], dtype=object))
+            columns['correct'].append(correct)
+            columns['answer'].append(answers.astype(object))
+
+    if len(columns['index']) == 0:
+        return pd.DataFrame()
+
+    # Build the long-format result in a single allocation
+    with phase('concat') as concat:
+        columns = {column: np.concatenate(values) for column, values in columns.items()}
+        index = columns.pop('index')
+
+        return concat.output(pd.DataFrame(columns, index=index))
+
+# Content hash of a file, cached until the file changes
+@profiled
+def file_hash(path):
+    return _file_hash(path, os.stat(path).st_mtime_ns)
+
+@functools.lru_cache(maxsize=None)
+def _file_hash(path, mtime):
+    with open(path, 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+# Check quiz answers, only re-grading rows that are new or changed, or whose quiz changed, since the last run
+@profiled
+def check_answers_cached(participant_tasks_df, store_file='data/answers-checked.pkl'):
+    answer_columns = sorted(column for column in participant_tasks_df.columns if column.startswith('Q'))
+    result_columns = ['participant_ID', 'task', 'question_nr', 'dimension', 'level', 'correct', 'answer']
+
+    with phase('hash_rows', participant_tasks_df=participant_tasks_df):
+        rows_df = participant_tasks_df[['participant_ID', 'task']].copy()
+        rows_df['row_hash'] = pd.util.hash_pandas_object(participant_tasks_df[answer_columns], index=False).to_numpy()
+        rows_df['quiz_hash'] = rows_df['task'].map({
+            task: file_hash(f'../task/questions/{task}.json') 
+            for task in rows_df['task'].unique()
+        })
+        fingerprint = hashlib.sha256(pd.util.hash_pandas_object(rows_df, index=True).to_numpy().tobytes()).hexdigest()
+
+    with phase('read_store'):
+        store = pd.read_pickle(store_file) if os.path.exists(store_file) else None
+    # Stores of other answer columns, or without the answers schema (e.g., written empty by an earlier version), are rebuilt
+    if store is not None and (store['answer_columns'] != answer_columns or 'row_index' not in store['answers'].columns):
+        store = None
+
+    # Nothing changed at all, the stored result can be returned as is
+    if store is not None and store['fingerprint'] == fingerprint:
+        answers_df = store['answers']
+        if answers_df.empty:
+            return pd.DataFrame()
+        return answers_df[result_columns].set_axis(answers_df['row_index'].to_numpy(), axis=0)
+
+    # Determine which rows are new, edited, or have a changed quiz definition
+    if store is not None:
+        with phase('merge_store', rows_df=rows_df) as merge_store:
+            # Duplicate stored rows would duplicate the merged rows, and misalign the stale mask
+            store_rows_df = store['rows'].drop_duplicates(['participant_ID', 'task', 'row_hash', 'quiz_hash'])
+            stale = rows_df.merge(
+                store_rows_df, 
+                on=['participant_ID', 'task', 'row_hash', 'quiz_hash'], 
+                how='left', 
+                indicator=True
+            )['_merge'].to_numpy() == 'left_only'
+            answers_df = merge_store.output(store['answers'][result_columns].merge(
+                rows_df.loc[~stale, ['participant_ID', 'task']], 
+                on=['participant_ID', 'task']
+            ))
+    else:
+        stale = np.ones(len(rows_df), dtype=bool)
+        answers_df = pd.DataFrame()
+
+    if stale.any():
+        graded_df = check_answers(participant_tasks_df[stale]).reset_index(drop=True)
+        answers_df = graded_df if answers_df.empty else pd.concat([answers_df, graded_df], ignore_index=True)
+
+    # Restore the row order and index of check_answers (per task, per question, per row)
+    if not answers_df.empty:
+        with phase('restore_order', answers_df=answers_df):
+            order_df = rows_df[['participant_ID', 'task']].copy()
+            order_df['row_index'] = participant_tasks_df.index
+            order_df['row_position'] = np.arange(len(order_df))
+            order_df['task_position'] = order_df['task'].map({task: i for i, task in enumerate(order_df['task'].unique())})
+
+            answers_df = answers_df\
+                .merge(order_df, on=['participant_ID', 'task'])\
+                .sort_values(['task_position', 'question_nr', 'row_position'], kind='stable')\
+                [result_columns + ['row_index']]\
+                .reset_index(drop=True)
+
+    # An empty result is stored with its columns, so the next run can merge with it
+    if answers_df.empty:
+        answers_df = pd.DataFrame(columns=result_columns + ['row_index'])
+
+    with phase('write_store'):
+        os.makedirs(os.path.dirname(store_file) or '.', exist_ok=True)
+        pd.to_pickle({
+            'answer_columns': answer_columns,
+            'fingerprint': fingerprint,
+            'rows': rows_df.reset_index(drop=True),
+            'answers': answers_df,
+        }, f'{store_file}.tmp')
+        os.replace(f'{store_file}.tmp', store_file)
+
+    if answers_df.empty:
+        return pd.DataFrame()
+
+    return answers_df[result_columns].set_axis(answers_df['row_index'].to_numpy(), axis=0)
+
+# Write a JSON file atomically, via a temporary file per process, so parallel readers and writers never see a partial file
+def write_json_atomic(path, data):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+# Load all sheets of an Excel workbook, cached as Feather files (one per sheet) until the workbook changes.
+# Cache files are written atomically, so processes loading the workbook in parallel never read a partial cache
+@profiled
+def load_workbook(file, cache_dir=None):
+    cache_dir = cache_dir or f'{os.path.splitext(file)[0]}-cache'
+    meta_file = os.path.join(cache_dir, 'meta.json')
+    mtime = os.stat(file).st_mtime_ns
+
+    meta = None
+    if os.path.exists(meta_file):
+        with open(meta_file) as f:
+            meta = json.load(f)
+
+        # A workbook that was only touched (but not changed) keeps its cache
+        if meta['mtime'] != mtime:
+            if meta['hash'] == file_hash(file):
+                meta['mtime'] = mtime
+                write_json_atomic(meta_file, meta)
+            else:
+                meta = None
 
-        # Check every question in the quiz one by one
-        for i, question in enumerate(quiz):
-            question_nr = i + 1
-            answer_column = f'Q{question_nr}'
-
-            answer_correct_df = False
-
-            # Check multiple choice questions
-            if question['type'] == "multiple_choice":
-                answer_df = answers_df[answer_column]
-                answer_correct_df = answer_df == question['options'][question['answer']]
-
-            # Check questions asking for a single line number
-            elif question['type'] == "line":
-                answer_df = answers_df[answer_column].replace(r'\.0*$', '', regex=True).astype(int)
-                answer_correct_df = answer_df.isin(question['answer'])
-
-            # Check questions asking for a range of line numbers
-            elif question['type'] == "block":
-                start_df = answers_df[f'{answer_column}_1'].replace(r'\.0*$', '', regex=True).astype(int)
-                end_df = answers_df[f'{answer_column}_2'].replace(r'\.0*$', '', regex=True).astype(int)
-                answer_df = pd.concat([start_df, end_df], axis=1).agg(list, axis=1)
-                answer_correct_df = answer_df.isin(question['answer'])
-
-            # Check questions asking for one or more textual inputs, check for exact equality or using regex
-            elif question['type'] in ['text', 'regex']:
-                if 'multiple' in question and question['multiple']:
-                    answer_dfs = [
-                        answers_df[f'{answer_column}_{i + 1}'].astype(str).str.strip().str.lower() 
-                        for i in range(len(question['answer']))
-                    ]
-                    answer_df = pd.concat(answer_dfs, axis=1).agg(list, axis=1)
-                    correct_answers = question['answer']
-                else:
-                    answer_df = answers_df[answer_column].astype(str).str.strip().str.lower()
-                    answer_dfs = [answer_df]
-                    correct_answers = [question['answer']]
-
-                answer_correct_dfs = []
-
-                for answer_field_df, correct_answer in zip(answer_dfs, correct_answers):
-                    if question['type'] == 'text':
-                        if isinstance(correct_answer, str):
-                            correct_answer = [correct_answer]
-                            
-                        answer_correct_dfs.append(answer_field_df.isin([str(answer).lower() for answer in correct_answer]))
-                    elif question['type'] == 'regex':
-                        answer_correct_dfs.append(answer_field_df.str.match(str(correct_answer), case=False))
-                answer_correct_df = pd.concat(answer_correct_dfs, axis=1).all(axis=1)
-
-            # Append the checked answers for this question to the DataFrame
-            answer_checked_df = answers_df[['participant_ID', 'task']].copy()
-            answer_checked_df['question_nr'] = question_nr
-            answer_checked_df['dimension'] = question['dimension']
-            answer_checked_df['level'] = question['level']
-            answer_checked_df['correct'] = answer_correct_df
-            answer_checked_df['answer'] = answer_df
-
-            answers_checked_df = pd.concat([answers_checked_df, answer_checked_df])
-
-    return answers_checked_df
+    if meta is None:
+        # Parse every sheet in a single pass
+        with phase('read_excel'), pd.ExcelFile(file) as excel_file:
+            sheets = pd.read_excel(excel_file, sheet_name=None)
+
+        os.makedirs(cache_dir, exist_ok=True)
+        meta = {'mtime': mtime, 'hash': file_hash(file), 'sheets': {}}
+
+        for i, (sheet_name, sheet_df) in enumerate(sheets.items()):
+            sheet_df = sheet_df.copy()
+            sheet_df.columns = [str(column) for column in sheet_df.columns]
+
+            # Columns mixing text and numbers cannot be stored typed, these are stored as text
+            for column in sheet_df.columns[sheet_df.dtypes == object]:
+                types = sheet_df[column].dropna().map(type).unique()
+                if len(types) > 1:
+                    sheet_df[column] = sheet_df[column].where(sheet_df[column].isna(), sheet_df[column].astype(str))
+
+            sheet_file = f'sheet-{i}.feather'
+            sheet_path = os.path.join(cache_dir, sheet_file)
+            sheet_df.reset_index(drop=True).to_feather(f'{sheet_path}.{os.getpid()}.tmp')
+            os.replace(f'{sheet_path}.{os.getpid()}.tmp', sheet_path)
+            meta['sheets'][sheet_name] = sheet_file
+
+        write_json_atomic(meta_file, meta)
+
+    return {
+        sheet_name: functools.partial(load_workbook_sheet, os.path.join(cache_dir, sheet_file))
+        for sheet_name, sheet_file in meta['sheets'].items()
+    }
+
+# Load a single cached workbook sheet
+@profiled
+def load_workbook_sheet(sheet_file, columns=None):
+    sheet_df = pd.read_feather(sheet_file, columns=columns)
+
+    # Missing text values are read back as None, restore them to NaN as read_excel does
+    for column in sheet_df.columns[sheet_df.dtypes == object]:
+        sheet_df[column] = sheet_df[column].where(sheet_df[column].notna(), np.nan)
+
+    return sheet_df
 
 # Load coding data
-def load_codes(sheet_name, additional_columns = [], code_postfix=None):
-    with pd.ExcelFile('data/coding.xlsx') as file:
-        codes_df = pd\
-            .read_excel(file, sheet_name=sheet_name, usecols=['participant_ID', *additional_columns, 'Codes']).rename(columns={'Codes': 'code'})
-            
+@profiled
+def load_codes(sheet_name, additional_columns = [], code_postfix=None, file='data/coding.xlsx'):
+    codes_df = load_workbook(file)[sheet_name](['participant_ID', *additional_columns, 'Codes']).rename(columns={'Codes': 'code'})
+
+    with phase('explode', codes_df=codes_df) as explode:
         codes_df['code'] = codes_df['code'].str.split(',')
         codes_df = codes_df.explode('code')
         codes_df['code'] = codes_df['code'].str.strip()
-        codes_df = codes_df[
+        codes_df = explode.output(codes_df[
             (~codes_df['code'].isna()) & 
             (codes_df['code'] != '')
-        ].reset_index(drop=True)
+        ].reset_index(drop=True))
 
-        if code_postfix is not None:
-            codes_df[['code', code_postfix]] = codes_df['code'].str.split('/', n=1, expand=True)
+    if code_postfix is not None:
+        codes_df[['code', code_postfix]] = codes_df['code'].str.split('/', n=1, expand=True)
 
-        code_levels_df = codes_df['code'].str.split(':').apply(pd.Series)
+    with phase('split_levels'):
+        code_levels_df = codes_df['code'].str.split(':', expand=True)
         code_levels_df.columns = [f'code_level_{i + 1}' for i in code_levels_df.columns]
-        codes_df = pd.concat([codes_df, code_levels_df], axis=1)
+        codes_df = pd.concat([codes_df, code_levels_df.astype('category')], axis=1)
 
     return codes_df
 
-# Count code distributions per (sub-)category, both relative to the parent category and to the total number of items
-def codes_level_count(
-    items_df,
-    items_columns,
-    codes_df,
-    levels,
-):
-    # Include counts per code (category), and frequency relative to parent
-    counts = codes_df.groupby(levels).size().reset_index(name=f'count')
-    if len(levels) <= 1:
-        counts['parent_count'] = len(codes_df)
-    else:
-        parent_count = codes_df.groupby(levels[:-1]).size().reset_index(name='parent_count')
-        counts = counts.merge(parent_count, on=levels[:-1], how='left')
+# Code categories of the user inputs, as plotted in user-study.ipynb (and rebuilt by pipeline.py)
+interaction_code_categories = [
+    {
+        'title': 'Question type',
+        'code': 'question',
+        'stat': 'frequency_parent',
+        'label': 'Relative frequency',
+        'groups': [
+            ['open', 'instruction', 'implicit'],
+            ['hypothesis'],
+        ]
+    },
+    {
+        'title': 'Question target',
+        'code': 'target',
+        'stat': 'frequency_parent',
+        'label': 'Relative frequency',
+        'groups': [
+            ['syntax', 'variable', 'line', 'block'],
+            ['snippet'],
+            ['concept'],
+            ['function_call', 'library'],
+        ]
+    },
+    {
+        'title': 'Question intent',
+        'code': 'intent',
+        'stat': 'frequency_unique',
+        'label': 'Proportion of interactions',
+        'groups': [
+            ['purpose', 'rationale', 'result'],
+            ['value', 'trace', 'effect'],
+        ]
+    },
+    {
+        'title': 'Instructions',
+        'code': 'instruction',
+        'stat': 'frequency_unique',
+        'label': 'Proportion of interactions',
+        'groups': [
+            ['short', 'summary'],
+            ['detail', 'step_by_step'],
+        ],
+    },
+    {
+        'title': 'Conversational features',
+        'code': 'conversation',
+        'stat': 'frequency_unique',
+        'label': 'Proportion of interactions',
+        'groups': [
+            ['follow_up'],
+            ['polite'],
+            ['meta'],
+            ['accidental_submit'],
+        ],
+    },
+]
+
+# Groups of the columns of the LaTeX code tables, per approach and per task
+approach_table_group = {
+    'column': 'model',
+    'title': 'Approach',
+    'options': [
+        {'value': 'control', 'title': 'Control'},
+        {'value': 'tom', 'title': '\\approach{}'},
+    ]
+}
+task_table_group = {
+    'column': 'task',
+    'title': 'Task',
+    'options': [
+        {'value': 'natural-language-processing', 'title': 'Task 1'},
+        {'value': 'data-analysis', 'title': 'Task 2'},
+    ]
+}
+
+# Clusters of the code pie charts, by whether the participant uses hypotheses and by approach
+hypotheses_clusters = [
+    {'title': 'Does not use hypotheses', 'column': 'uses_hypotheses', 'value': False},
+    {'title': 'Uses hypotheses', 'column': 'uses_hypotheses', 'value': True},
+]
+model_clusters = [
+    {'title': 'Control', 'column': 'model', 'value': 'control'},
+    {'title': 'ToMMY', 'column': 'model', 'value': 'tom'},
+]
+
+# Regressions of the user study on quiz performance (Poisson) and quiz time (Gaussian), see performance_data
+performance_formula = 'n_correct ~ uses_tom + experience_programming_estimated + experience_domain + familiarity_LLM'
+quiz_time_formula = 'quiz_time ~ uses_tom + experience_programming + experience_domain + familiarity_LLM'
+
+# Participants that asked at least one hypothesis
+def participant_IDs_hypotheses(input_codes_df):
+    return input_codes_df[input_codes_df['code'] == 'question:hypothesis']['participant_ID'].unique()
+
+# Merge the participant tasks with the participants and their number of correct answers, for the regressions
+def performance_data(participant_tasks_df, participants_df, answers_checked_df, participant_IDs_hypotheses):
+    performance_df = participant_tasks_df.merge(
+        participants_df,
+        on='participant_ID'
+    ).merge(
+        answers_checked_df.groupby(['participant_ID', 'task']).agg(n_correct=('correct', 'sum')).reset_index(),
+        on=['participant_ID', 'task']
+    )
+
+    performance_df['uses_hypotheses'] = performance_df['participant_ID'].isin(participant_IDs_hypotheses)
+
+    performance_df['uses_tom'] = performance_df['model'] == 'tom'
+    performance_df['experience_domain'] = performance_df.apply(lambda row: row['experience_data_analysis'] if row['task'] == 'data-analysis' else row['experience_nlp'], axis=1)
 
-    counts['frequency_parent'] = counts['count'] / counts['parent_count']
-    counts = counts.drop(columns=['parent_count'])
+    return performance_df
 
-    # Include counts of code (category) per item, and frequency relative to item count
-    counts_unique = codes_df.drop_duplicates(items_columns + levels).groupby(levels).size().reset_index(name=f'count_unique').fillna(0)
-    items_count = len(items_df)
-    counts_unique['frequency_unique'] = counts_unique['count_unique'] / items_count
-    return counts.merge(counts_unique, on=levels, how='left')
+# Count code rows per key (combination of level codes, optionally prefixed by the group), ignoring keys with missing levels
+@profiled
+def count_keys(keys_df, keys):
+    keys_df = keys_df[(keys_df[keys] >= 0).all(axis=1)]
+    return keys_df.groupby(keys, sort=False).size()
 
+# Count code distributions per (sub-)category, both relative to the parent category and to the total number of items
+@profiled
 def codes_count(
     items_df,
     items_columns,
@@ -131,69 +480,133 @@ def codes_count(
     group_columns = []
 ):
     levels = [column for column in codes_df.columns if column.startswith('code_level_')]
+    group_values = {group_column: items_df[group_column].unique() for group_column in group_columns}
+
     # Include counts per item
+    group_items_counts = {
+        group_column: items_df[group_column].value_counts()
+        for group_column in group_columns
+    }
     result = pd.DataFrame([{
         'count': len(items_df),
         **{
-            f'{group_column}_{group_value}_count': len(items_df[items_df[group_column] == group_value])
+            f'{group_column}_{group_value}_count': int(group_items_counts[group_column].get(group_value, 0)) if not pd.isna(group_value) else 0
             for group_column in group_columns
-            for group_value in items_df[group_column].unique()
+            for group_value in group_values[group_column]
         }
     }])
 
-    for i in range(len(levels)):
-        counts = codes_level_count(
-            items_df,
-            items_columns,
-            codes_df,
-            levels[:i+1]
-        )
+    # Convert codes to categorical codes once, missing levels become -1
+    with phase('factorize', codes_df=codes_df):
+        level_uniques = {}
+        keys_df = pd.DataFrame({
+            'item': codes_df.groupby(items_columns, sort=False, dropna=False).ngroup().to_numpy()
+        })
+        for level in levels:
+            keys_df[level], level_uniques[level] = pd.factorize(codes_df[level])
+            level_uniques[level] = np.asarray(level_uniques[level], dtype=object)
+
+    # Stack the codes of every group value, where each (group column, group value) pair is a categorical group
+    groups = [(group_column, group_value) for group_column in group_columns for group_value in group_values[group_column]]
+    group_items_count = result.iloc[0][[f'{group_column}_{group_value}_count' for group_column, group_value in groups]].to_numpy(dtype=float)
+
+    if len(groups) > 0:
+        with phase('group_keys', items_df=items_df, codes_df=codes_df):
+            items_keys_columns = items_columns + [column for column in group_columns if column not in items_columns]
+            codes_keys_df = codes_df[items_columns].copy()
+            codes_keys_df[['item'] + levels] = keys_df[['item'] + levels].to_numpy()
+            joined_df = items_df[items_keys_columns].merge(codes_keys_df, on=items_columns, how='inner')
+
+            group_keys_dfs = []
+            offset = 0
+            for group_column in group_columns:
+                values = pd.Index(np.asarray(group_values[group_column], dtype=object))
+                group = values.get_indexer(np.asarray(joined_df[group_column], dtype=object))
+                valid = (group >= 0) & joined_df[group_column].notna().to_numpy()
+                group_keys_df = joined_df.loc[valid, ['item'] + levels].copy()
+                group_keys_df['group'] = group[valid] + offset
+                group_keys_dfs.append(group_keys_df)
+                offset += len(values)
+            group_keys_df = pd.concat(group_keys_dfs, ignore_index=True)
+
+    level_counts = []
 
-        # Also include counts per group
-        for group_column in group_columns:
-            for group_value in items_df[group_column].unique():
-                items_filtered_df = items_df[items_df[group_column] == group_value]
-                counts_filtered = codes_level_count(
-                    items_filtered_df,
-                    items_columns,
-                    items_filtered_df.merge(codes_df, on=items_columns, how='inner'),
-                    levels[:i+1]
-                )
+    for i in range(len(levels)):
+        with phase(f'level_{i + 1}'):
+            keys = levels[:i + 1]
 
-                columns = {column: f'{group_column}_{group_value}_{column}' for column in ['count', 'frequency_parent', 'count_unique', 'frequency_unique']}
+            # Include counts per code (category), and frequency relative to parent
+            counts = count_keys(keys_df, keys).sort_index()
+            parent_count = len(codes_df) if i == 0 else count_keys(keys_df, keys[:-1]).reindex(counts.index.droplevel(-1)).to_numpy()
+            level_counts.append(counts)
 
-                counts = pd.merge(
-                    counts, 
-                    counts_filtered.rename(columns=columns), 
-                    on=levels[:i+1], 
-                    how='left'
-                )
-                for column in columns.values():
-                    counts[column] = counts[column].fillna(0)
+            # Include counts of code (category) per item, and frequency relative to item count
+            counts_unique = count_keys(keys_df[['item'] + keys].drop_duplicates(), keys).reindex(counts.index)
 
-        result = pd.concat([
-            result, 
-            counts
-        ], ignore_index=True)
+            index = counts.index if i > 0 else pd.MultiIndex.from_arrays([counts.index])
+            level_columns = {
+                level: level_uniques[level][index.get_level_values(j)]
+                for j, level in enumerate(keys)
+            }
+            level_columns['count'] = counts.to_numpy()
+            level_columns['frequency_parent'] = counts.to_numpy() / parent_count
+            level_columns['count_unique'] = counts_unique.to_numpy()
+            level_columns['frequency_unique'] = counts_unique.to_numpy() / len(items_df)
+
+            # Also include counts per group, all groups at once
+            if len(groups) > 0:
+                group_counts = count_keys(group_keys_df, ['group'] + keys)
+                if i == 0:
+                    group_parent_count = group_keys_df.groupby('group').size().reindex(group_counts.index.get_level_values('group'))
+                else:
+                    group_parent_count = count_keys(group_keys_df, ['group'] + keys[:-1]).reindex(group_counts.index.droplevel(-1))
+                group_counts_unique = count_keys(group_keys_df[['group', 'item'] + keys].drop_duplicates(), ['group'] + keys)
+
+                group_stats = {
+                    'count': group_counts,
+                    'frequency_parent': group_counts / group_parent_count.to_numpy(),
+                    'count_unique': group_counts_unique,
+                    'frequency_unique': group_counts_unique / group_items_count[group_counts_unique.index.get_level_values('group')],
+                }
+                group_stats = {
+                    stat: values.unstack('group').reindex(index=counts.index, columns=range(len(groups))).to_numpy()
+                    for stat, values in group_stats.items()
+                }
+
+                for j, (group_column, group_value) in enumerate(groups):
+                    for stat, values in group_stats.items():
+                        column = values[:, j]
+                        missing = np.isnan(column)
+                        if stat in ['count', 'count_unique'] and not missing.any():
+                            column = column.astype(np.int64)
+                        else:
+                            column = np.where(missing, 0, column)
+                        level_columns[f'{group_column}_{group_value}_{stat}'] = column
+
+            # Include counts of the parent categories, to sort by later
+            for j, level in enumerate(keys):
+                level_columns[f'{level}_count'] = level_counts[j].reindex(index.droplevel(list(range(j + 1, len(keys))))).to_numpy()
+
+            level_df = pd.DataFrame(level_columns)
+
+            result = pd.concat([
+                result, 
+                level_df
+            ], ignore_index=True)
 
     # Sort the counts per level
-    for i, level in enumerate(levels):
-        result = pd.merge(
-            result, 
-            codes_df.groupby(levels[:i + 1]).size().reset_index(name=f'{level}_count'), 
-            on=levels[:i + 1], 
-            how='left'
+    with phase('sort', result=result):
+        result = result.sort_values(
+            by=[column for level in levels for column in [f'{level}_count', level]], 
+            ascending=[False, True]*len(levels), 
+            na_position='first'
         )
-    result = result.sort_values(
-        by=[column for level in levels for column in [f'{level}_count', level]], 
-        ascending=[False, True]*len(levels), 
-        na_position='first'
-    )
-    result = result.drop(columns=[f'{level}_count' for level in levels])
+        result = result.drop(columns=[f'{level}_count' for level in levels])
 
     return result.reset_index(drop=True)
 
 # Create a LaTeX table row for the code distributions
+@profiled
 def codes_latex_table_row(
     row,
     levels,
@@ -229,6 +642,7 @@ def codes_latex_table_row(
     return latex
 
 # Create a LaTeX table for the code distributions
+@profiled
 def codes_latex_table(
     file,
     items_df,
@@ -270,13 +684,14 @@ def codes_latex_table(
         [column_header for group in groups for _ in group['options']]) + '\\\\\n'
     latex += '\\midrule\n'
 
-    for _, row in counts_df.iterrows():
-        if not pd.isna(row[levels[0]]):
-            latex += codes_latex_table_row(
-                row, 
-                levels,
-                groups
-            )
+    with phase('rows', counts_df=counts_df):
+        for _, row in counts_df.iterrows():
+            if not pd.isna(row[levels[0]]):
+                latex += codes_latex_table_row(
+                    row, 
+                    levels,
+                    groups
+                )
 
     latex += '\\bottomrule\n'
 
@@ -285,8 +700,110 @@ def codes_latex_table(
     with open(file, 'w') as file:
         file.write(latex)
 
-# Plot the code distributions
-def plot_codes_bars(file, participants_df, codes_count_df, categories, index_order, index_labels, cluster=None):
+# Hash the data and style spec of a figure
+@profiled
+def figure_hash(figure):
+    digest = hashlib.sha256()
+
+    for key, value in sorted(figure.items()):
+        if key == 'file':
+            continue
+
+        digest.update(key.encode())
+        if isinstance(value, pd.DataFrame):
+            digest.update(json.dumps([str(column) for column in value.columns] + [str(index) for index in value.index]).encode())
+            digest.update(pd.util.hash_pandas_object(value, index=False).to_numpy().tobytes())
+        else:
+            digest.update(json.dumps(value, sort_keys=True, default=str).encode())
+
+    return digest.hexdigest()
+
+# Read the figure hash stored in the metadata of a rendered figure
+@profiled
+def rendered_figure_hash(file):
+    if not os.path.exists(file):
+        return None
+
+    with Image.open(file) as image:
+        return image.text.get('Figure hash')
+
+# Use a non-interactive backend in figure rendering worker processes
+@profiled
+def use_headless_backend():
+    matplotlib.use('Agg')
+
+# Render a single figure in a worker process
+@profiled
+def render_figure(render, figure):
+    render(**figure, metadata={'Figure hash': figure_hash(figure)})
+    plt.close('all')
+
+# Render figures in a process pool, skipping figures whose data and style spec did not change since they were last rendered
+@profiled
+def render_figures(render, figures, processes=None):
+    n_figures = len(figures)
+    figures = [figure for figure in figures if rendered_figure_hash(figure['file']) != figure_hash(figure)]
+
+    if len(figures) > 0:
+        with concurrent.futures.ProcessPoolExecutor(processes, initializer=use_headless_backend) as executor:
+            list(executor.map(functools.partial(render_figure, render), figures))
+
+    return {
+        'rendered': len(figures), 
+        'skipped': n_figures - len(figures),
+    }
+
+# Render a single stacked bar chart of code distributions
+@profiled
+def render_codes_bars(file, category, data, colors, cluster_data, xticklabels, metadata=None):
+    sns.set(style='whitegrid')
+    fig, ax = plt.subplots(figsize=(10, 4))
+    fig.set_tight_layout(True)
+
+    if cluster_data is not None:
+        cluster_data.plot(kind='bar', width=1.01, edgecolor='none', ax=ax, color='#bbb')
+
+    data.plot(kind='bar', stacked=True, ax=ax, color=colors)
+
+    fig.suptitle(category['title'], y=1.02)
+
+    ax.set_xlabel(None)
+    ax.set_xticks(range(len(xticklabels)))
+    ax.set_xticklabels(xticklabels)
+
+    ax.set_yticks([0, .25, .5, .75, 1])
+    ax.set_yticklabels([0, .25, .5, .75, 1])
+    ax.set_ylim(0, 1)
+    ax.yaxis.set_major_formatter(plt.FuncFormatter(lambda x, _: f'{x:.0%}'))
+    ax.set_ylabel(category['label'])
+
+    ax.grid(axis='y')
+    ax.get_legend().remove()
+
+    # Fix legend order
+    n_columns = 8
+    handles, labels = ax.get_legend_handles_labels()
+    if cluster_data is not None:
+        handles = handles[1:]
+        labels = labels[1:]
+    n_rows = (len(handles) + n_columns - 1) // n_columns
+
+    handles_labels = [
+        (handles[i * n_columns + j], labels[i * n_columns + j])
+        for j in range(n_columns)
+        for i in range(n_rows)
+        if i * n_columns + j < len(handles)
+    ]
+
+    handles, labels = zip(*handles_labels)
+    fig.legend(handles, labels, loc='upper center', bbox_to_anchor=(.5, .97), handlelength=1, handletextpad=0.5, ncol=n_columns)
+
+    with phase('savefig'):
+        plt.savefig(file, bbox_inches='tight', metadata=metadata)
+
+# Plot the code distributions, optionally rendered headless in a process pool, skipping unchanged figures
+@profiled
+def plot_codes_bars(file, participants_df, codes_count_df, categories, index_order, index_labels, cluster=None, headless=False, processes=None):
     codes_count_df = codes_count_df.rename(columns={'code_level_1': 'category', 'code_level_2': 'code'})
 
     palettes = [
@@ -296,11 +813,8 @@ def plot_codes_bars(file, participants_df, codes_count_df, categories, index_ord
         'Purples',
     ]
 
-    sns.set(style='whitegrid')
+    figures = []
     for i, category in enumerate(categories):
-        fig, ax = plt.subplots(figsize=(10, 4))
-        fig.set_tight_layout(True)
-
         category_code = category['code']
         stat = category['stat']
         groups = category['groups']
@@ -333,61 +847,76 @@ def plot_codes_bars(file, participants_df, codes_count_df, categories, index_ord
             observed=True,
         ).reset_index().sort_values('participant_ID')
 
+        cluster_data = None
         if cluster is not None:
             cluster_participant_IDs = set(participants_df[
                 participants_df[cluster['column']] == cluster['value']
             ]['participant_ID'] if 'column' in cluster else participants_df['participant_ID'])
             cluster_data = category_df[['participant_ID']].copy()
             cluster_data[cluster['title']] = cluster_data['participant_ID'].apply(lambda x: 1 if x in cluster_participant_IDs else 0)
-            cluster_data.set_index('participant_ID').plot(kind='bar', width=1.01, edgecolor='none', ax=ax, color='#bbb')
+            cluster_data = cluster_data.set_index('participant_ID')
 
         data = category_df.set_index('participant_ID')[codes].rename(columns={
             code: code.replace('_', ' ').capitalize()
             for code in codes
         })
 
-        data.plot(kind='bar', stacked=True, ax=ax, color=colors)
+        figures.append({
+            'file': f"{file}_{category['code']}.png",
+            'category': category,
+            'data': data,
+            'colors': colors,
+            'cluster_data': cluster_data,
+            'xticklabels': [index_labels[participant_ID] for participant_ID in index_order],
+        })
 
-        fig.suptitle(category['title'], y=1.02)
+    if headless:
+        return render_figures(render_codes_bars, figures, processes)
 
-        ax.set_xlabel(None)
-        ax.set_xticks(range(len(index_order)))
-        ax.set_xticklabels([
-            index_labels[participant_ID] for participant_ID in 
-            index_order
-        ])
+    for figure in figures:
+        render_codes_bars(**figure)
 
-        ax.set_yticks([0, .25, .5, .75, 1])
-        ax.set_yticklabels([0, .25, .5, .75, 1])
-        ax.set_ylim(0, 1)
-        ax.yaxis.set_major_formatter(plt.FuncFormatter(lambda x, _: f'{x:.0%}'))
-        ax.set_ylabel(category['label'])
+# Render a single set of pie charts of code distributions, one per cluster
+@profiled
+def render_codes_pie(file, category, data, colors, titles, labels, metadata=None):
+    sns.set(style='whitegrid')
+    fig, axs = plt.subplots(1, len(titles), figsize=(10, 4))
+
+    for i, title in enumerate(titles):
+        handles, _, _ = axs[i].pie(
+            data.iloc[i],
+            colors=colors,
+            autopct=lambda p: '{:.0f}%'.format(round(p)) if p > 0 else '', 
+            pctdistance=1.2,
+            normalize=False,
+            textprops={'fontsize': 10},
+            counterclock=False,
+            startangle=90
+        )
+        axs[i].set_title(title)
 
-        ax.grid(axis='y')
-        ax.get_legend().remove()
+    fig.suptitle(category['title'], y=1.06)
 
-        # Fix legend order
-        n_columns = 8
-        handles, labels = ax.get_legend_handles_labels()
-        if cluster is not None:
-            handles = handles[1:]
-            labels = labels[1:]
-        n_rows = (len(handles) + n_columns - 1) // n_columns
-
-        handles_labels = [
-            (handles[i * n_columns + j], labels[i * n_columns + j])
-            for j in range(n_columns)
-            for i in range(n_rows)
-            if i * n_columns + j < len(handles)
-        ]
+    # Fix legend order
+    n_columns = 6
+    n_rows = (len(handles) + n_columns - 1) // n_columns
 
-        handles, labels = zip(*handles_labels)
-        fig.legend(handles, labels, loc='upper center', bbox_to_anchor=(.5, .97), handlelength=1, handletextpad=0.5, ncol=n_columns)
+    handles_labels = [
+        (handles[i * n_columns + j], labels[i * n_columns + j])
+        for j in range(n_columns)
+        for i in range(n_rows)
+        if i * n_columns + j < len(handles)
+    ]
+    handles, labels = zip(*handles_labels)
+    fig.legend(handles, labels, loc='upper center', bbox_to_anchor=(.5, 1.02), handlelength=1, handletextpad=0.5, ncol=n_columns)
+    fig.set_tight_layout(True)
 
-        plt.savefig(f"{file}_{category['code']}.png", bbox_inches='tight')
+    with phase('savefig'):
+        plt.savefig(file, bbox_inches='tight', metadata=metadata)
 
-# Plot the code distributions
-def plot_codes_pie(file, codes_count_df, categories, clusters):
+# Plot the code distributions, optionally rendered headless in a process pool, skipping unchanged figures
+@profiled
+def plot_codes_pie(file, codes_count_df, categories, clusters, headless=False, processes=None):
     codes_count_df = codes_count_df.rename(columns={'code_level_1': 'category', 'code_level_2': 'code'})
 
     palettes = [
@@ -397,10 +926,8 @@ def plot_codes_pie(file, codes_count_df, categories, clusters):
         'Purples',
     ]
 
+    figures = []
     for category in categories:
-        sns.set(style='whitegrid')
-        fig, axs = plt.subplots(1, len(clusters), figsize=(10, 4))
-
         category_code = category['code']
         stat = category['stat']
         groups = category['groups']
@@ -434,43 +961,360 @@ def plot_codes_pie(file, codes_count_df, categories, clusters):
             observed=True,
         ).reset_index()
 
-        for i, cluster in enumerate(clusters):
-            key = f"{cluster['column']}_{cluster['value']}"
-            data = category_df[category_df['cluster'] == key][codes].iloc[0]
-            handles, _, _ = axs[i].pie(
-                data,
-                colors=colors,
-                autopct=lambda p: '{:.0f}%'.format(round(p)) if p > 0 else '', 
-                pctdistance=1.2,
-                normalize=False,
-                textprops={'fontsize': 10},
-                counterclock=False,
-                startangle=90
-            )
-            axs[i].set_title(cluster['title'])
+        figures.append({
+            'file': f"{file}_{category['code']}.png",
+            'category': category,
+            'data': pd.DataFrame([
+                category_df[category_df['cluster'] == key][codes].iloc[0]
+                for key in cluster_keys
+            ]),
+            'colors': colors,
+            'titles': [cluster['title'] for cluster in clusters],
+            'labels': [
+                code.replace('_', ' ').capitalize()
+                for code in codes
+            ],
+        })
 
-        fig.suptitle(category['title'], y=1.06)
+    if headless:
+        return render_figures(render_codes_pie, figures, processes)
 
-        # Fix legend order
-        n_columns = 6
-        labels = [
-            code.replace('_', ' ').capitalize()
-            for code in codes
-        ]
-        n_rows = (len(handles) + n_columns - 1) // n_columns
+    for figure in figures:
+        render_codes_pie(**figure)
 
-        handles_labels = [
-            (handles[i * n_columns + j], labels[i * n_columns + j])
-            for j in range(n_columns)
-            for i in range(n_rows)
-            if i * n_columns + j < len(handles)
-        ]
-        handles, labels = zip(*handles_labels)
-        fig.legend(handles, labels, loc='upper center', bbox_to_anchor=(.5, 1.02), handlelength=1, handletextpad=0.5, ncol=n_columns)
-        fig.set_tight_layout(True)
+# Process the raw client data (see clean-data.ipynb) into DataFrames of participants, participant tasks, interactions, and per-stage interaction traces
+@profiled
+def process_client_data(client_data, participant_ID_map, participant_time_adjustments={}):
+    participants_data = []
+    participant_steps_data = []
+    step_start_times = []
+    step_end_times = []
+    participant_interaction_data = []
+    participant_interaction_trace_data = []
 
-        plt.savefig(f"{file}_{category['code']}.png", bbox_inches='tight')
+    for participant in client_data:
+        if participant['username'] not in participant_ID_map:
+            continue
 
+        participant_ID = participant_ID_map[participant['username']]
+
+        # Participants (ID/group)
+        participants_data.append({
+            'participant_ID': participant_ID, 
+            'group': participant['group']
+        })
+
+        # Participant task steps (interaction/quiz per task), timed at once for all participants below
+        for step in participant['steps']:
+            if step['key'].startswith('interaction-'):
+                type = 'interaction'
+            elif step['key'].startswith('quiz-'):
+                type = 'quiz'
+            else:
+                continue
+
+            participant_steps_data.append((len(participants_data) - 1, participant['username'], participant_ID, step['key'].split('-', 1)[1], type))
+            step_start_times.append(step['startTime'])
+            step_end_times.append(step['endTime'])
+
+        # Participant interactions (input/response pairs with optional internal questions and mental state per task)
+        messages = participant['interactionMessages']
+        messages.sort(key=lambda x: x['order'])
+        participant_interaction_turns = {}
+
+        for message in messages:
+            if message['task'] not in participant_interaction_turns:
+                participant_interaction_turns[message['task']] = []
+
+            if message['type'] == 'user':
+                participant_interaction_turns[message['task']].append({
+                    'input': message['content'], 
+                    'response': None,
+                    'questions': None,
+                    'mental_state': None,
+                    'response_time': message['timeMS'] / 1000
+                })
+                continue
+            elif message['type'] == 'ai':
+                stage = 'response'
+                participant_interaction_turns[message['task']][-1]['response'] = message['content']
+            elif message['type'] == 'internal':
+                if participant_interaction_turns[message['task']][-1]['questions'] is None:
+                    stage = 'questions'
+                    participant_interaction_turns[message['task']][-1]['questions'] = message['content']
+                elif participant_interaction_turns[message['task']][-1]['mental_state'] is None:
+                    stage = 'mental_state'
+                    participant_interaction_turns[message['task']][-1]['mental_state'] = message['content']
+                else:
+                    continue
+            else:
+                continue
+
+            # Per-stage traces (latency and token usage of every model call)
+            participant_interaction_trace_data.append({
+                'participant_ID': participant_ID,
+                'task': message['task'],
+                'turn': len(participant_interaction_turns[message['task']]),
+                'stage': stage,
+                'wall_time': message['timeMS'] / 1000 if message['timeMS'] is not None else None,
+                'time_to_first_token': None,
+                'prompt_tokens': message.get('tokenCountInput'),
+                'completion_tokens': message.get('tokenCountOutput'),
+            })
+
+        for task, turns in participant_interaction_turns.items():
+            for i, turn in enumerate(turns):
+                participant_interaction_data.append({
+                    'participant_ID': participant_ID, 
+                    'task': task,
+                    'turn': i + 1, 
+                    **turn
+                })
+
+    # Participant tasks (time to complete interaction/quiz per taks)
+    with phase('step_times'):
+        step_times = (
+            pd.to_datetime(pd.Series(step_end_times, dtype=object), utc=True, format='ISO8601')
+            - pd.to_datetime(pd.Series(step_start_times, dtype=object), utc=True, format='ISO8601')
+        ).dt.total_seconds().round().astype(int).tolist()
+
+    participant_tasks = {}
+    for (participant, username, participant_ID, task, type), time in zip(participant_steps_data, step_times):
+        participant_tasks.setdefault((participant, username, participant_ID), {}).setdefault(task, {})[type] = time
+
+    participant_tasks_data = []
+    for (_, username, participant_ID), tasks in participant_tasks.items():
+        for task, times in tasks.items():
+            interaction_time = times['interaction']
+            quiz_time = times['quiz']
+
+            # Apply time adjustments
+            if username in participant_time_adjustments and task in participant_time_adjustments[username]:
+                if 'interaction' in participant_time_adjustments[username][task]:
+                    interaction_time += participant_time_adjustments[username][task]['interaction']
+                if 'quiz' in participant_time_adjustments[username][task]:
+                    quiz_time += participant_time_adjustments[username][task]['quiz']
+
+            participant_tasks_data.append({
+                'participant_ID': participant_ID, 
+                'task': task, 
+                'interaction_time': interaction_time, 
+                'quiz_time': quiz_time
+            })
+
+    participants_df = pd.DataFrame(participants_data, columns=['participant_ID', 'group'])
+
+    participant_tasks_df = pd.DataFrame(participant_tasks_data, columns=['participant_ID', 'task', 'interaction_time', 'quiz_time'])
+    participant_tasks_df['interaction_time'] = participant_tasks_df['interaction_time'].astype('Int64')
+    participant_tasks_df['quiz_time'] = participant_tasks_df['quiz_time'].astype('Int64')
+
+    participant_interaction_df = pd.DataFrame(participant_interaction_data, columns=client_interaction_columns)
+    participant_interaction_trace_df = pd.DataFrame(participant_interaction_trace_data, columns=client_interaction_trace_columns)
+
+    return participants_df, participant_tasks_df, participant_interaction_df, participant_interaction_trace_df
+
+# Iterate over the objects in a (large) JSON array file one at a time, reading the file in chunks.
+# Elements are separated by exactly one comma, and a number is only decoded once it is followed by another character (or the file ends), as it may continue in the next chunk
+def iter_json_array(file, chunk_size=2 ** 20):
+    decoder = json.JSONDecoder()
+
+    with open(file) as f:
+        buffer = ''
+        position = 0
+        eof = False
+
+        # Read (at least) as much again after the unparsed part of the buffer
+        def read():
+            nonlocal buffer, position, eof
+            chunk = f.read(max(chunk_size, len(buffer) - position))
+            eof = chunk == ''
+            buffer = buffer[position:] + chunk
+            position = 0
+
+        # The next character after whitespace, reading more as needed, or None at the end of the file
+        def next_character():
+            nonlocal position
+            while True:
+                position = json_whitespace_pattern.match(buffer, position).end()
+                if position < len(buffer):
+                    return buffer[position]
+                if eof:
+                    return None
+                read()
+
+        if next_character() != '[':
+            raise ValueError(f'{file} does not contain a JSON array')
+        position += 1
+        if next_character() == ']':
+            return
+
+        while True:
+            if next_character() in [None, ']']:
+                raise ValueError(f'Expected an element of the JSON array in {file}')
+
+            try:
+                element, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # The next element continues beyond the buffer
+                if eof:
+                    raise
+                read()
+                continue
+
+            if type(element) in (int, float) and not eof and json_number_continuation_pattern.match(buffer, end).end() == len(buffer):
+                read()
+                continue
+
+            position = end
+            yield element
+
+            separator = next_character()
+            if separator == ']':
+                return
+            if separator != ',':
+                raise ValueError(f'Expected , or ] after element of the JSON array in {file}, found {separator!r}')
+            position += 1
+
+# Process the raw client data dump in batches of participants, appending the processed participants, participant tasks, interactions,
+# and interaction traces to files in output_dir, so that the dump never needs to fit in memory. Returns the paths of these files
+@profiled
+def stream_client_data(file, output_dir, participant_ID_map, participant_time_adjustments={}, batch_size=1000):
+    os.makedirs(output_dir, exist_ok=True)
+    output_files = {
+        'participants': os.path.join(output_dir, 'participants.csv'),
+        'participant_tasks': os.path.join(output_dir, 'tasks.csv'),
+        'interactions': os.path.join(output_dir, 'interactions.csv'),
+        'interaction_traces': os.path.join(output_dir, 'interaction-traces.jsonl'),
+    }
+
+    def write_batch(batch, first):
+        for (key, output_file), batch_df in zip(output_files.items(), process_client_data(batch, participant_ID_map, participant_time_adjustments)):
+            with phase(f'write_{key}', batch_df=batch_df):
+                if output_file.endswith('.jsonl'):
+                    with open(output_file, 'w' if first else 'a') as f:
+                        if len(batch_df) > 0:
+                            batch_df.to_json(f, orient='records', lines=True)
+                            f.write('\n')
+                else:
+                    batch_df.to_csv(output_file, mode='w' if first else 'a', header=first, index=False)
+
+    batch = []
+    first = True
+    for participant in iter_json_array(file):
+        # Skip participants that are not part of the study before batching
+        if participant['username'] not in participant_ID_map:
+            continue
+
+        batch.append(participant)
+        if len(batch) == batch_size:
+            write_batch(batch, first)
+            batch = []
+            first = False
+
+    if len(batch) > 0 or first:
+        write_batch(batch, first)
+
+    return output_files
+
+# Read a table of the processed client data written by stream_client_data, optionally as an iterator of chunks of chunksize rows
+def read_client_table(output_files, table, chunksize=None):
+    text_columns = {'participant_ID': str, 'task': str}
+
+    if table == 'interaction_traces':
+        if os.path.getsize(output_files[table]) == 0:
+            empty_df = pd.DataFrame(columns=client_interaction_trace_columns)
+            return empty_df if chunksize is None else iter([empty_df])
+        return pd.read_json(output_files[table], lines=True, dtype=text_columns, chunksize=chunksize)
+
+    dtypes = {
+        'participants': {'participant_ID': str, 'group': str},
+        'participant_tasks': {**text_columns, 'interaction_time': 'Int64', 'quiz_time': 'Int64'},
+        'interactions': {**text_columns, 'input': str, 'response': str, 'questions': str, 'mental_state': str},
+    }
+    return pd.read_csv(output_files[table], dtype=dtypes[table], chunksize=chunksize)
+
+# Load (the given tables of) the processed client data written by stream_client_data. The interactions and interaction traces grow with the dump,
+# and are better sorted into their final files with sort_client_table than loaded
+@profiled
+def load_client_data(output_files, tables=['participants', 'participant_tasks', 'interactions', 'interaction_traces']):
+    return tuple(read_client_table(output_files, table) for table in tables)
+
+# Natural sort key of a value, e.g., 'P2' before 'P10', as natsort orders the values in clean-data.ipynb
+def natural_key(value):
+    if not isinstance(value, str):
+        return ('', value)
+
+    return tuple(int(part) if i % 2 == 1 else part for i, part in enumerate(digits_pattern.split(value)))
+
+digits_pattern = re.compile(r'(\d+)')
+
+# Sort a table of the processed client data in the natural order of the key columns (stable), and write it to output_file (CSV or JSON lines),
+# without loading the table: sorted runs of chunksize rows are spilled to disk and merged, holding one row per run and chunksize rows of output in memory
+@profiled
+def sort_client_table(output_files, table, output_file, key_columns, chunksize=100000):
+    def row_key(row):
+        return tuple(natural_key(row[column]) for column in key_columns)
+
+    def read_run(run_file):
+        with open(run_file) as f:
+            for line in f:
+                yield json.loads(line)
+
+    def write_rows(rows, columns, first):
+        rows_df = pd.DataFrame(rows, columns=columns)
+        if output_file.endswith('.jsonl'):
+            with open(output_file, 'w' if first else 'a') as f:
+                if len(rows_df) > 0:
+                    rows_df.to_json(f, orient='records', lines=True)
+                    f.write('\n')
+        else:
+            rows_df.to_csv(output_file, mode='w' if first else 'a', header=first, index=False)
+
+    run_dir = output_file + '.runs'
+    os.makedirs(run_dir, exist_ok=True)
+    run_files = []
+    columns = None
+
+    try:
+        with phase('sort_runs'):
+            for chunk_df in read_client_table(output_files, table, chunksize):
+                columns = columns or chunk_df.columns.tolist()
+                rows = sorted(chunk_df.astype(object).where(chunk_df.notna(), None).to_dict('records'), key=row_key)
+
+                run_files.append(os.path.join(run_dir, f'{len(run_files)}.jsonl'))
+                with open(run_files[-1], 'w') as f:
+                    for row in rows:
+                        f.write(json.dumps(row) + '\n')
+
+        with phase('merge_runs'):
+            merged = heapq.merge(*[read_run(run_file) for run_file in run_files], key=row_key)
+            first = True
+            while (rows := list(itertools.islice(merged, chunksize))) or first:
+                write_rows(rows, columns, first)
+                first = False
+    finally:
+        for run_file in run_files:
+            os.remove(run_file)
+        os.rmdir(run_dir)
+
+# Load a JSON lines trace file of per-stage model calls (see agent.py and clean-data.ipynb)
+@profiled
+def load_traces(file):
+    return pd.read_json(file, lines=True, dtype={'participant_ID': str, 'task': str})
+
+# Join per-stage latency and token usage onto interactions, as '{stage}_{metric}' columns ('{agent}_{stage}_{metric}' if traced per agent)
+@profiled
+def join_traces(interactions_df, traces_df, on=['participant_ID', 'task', 'turn']):
+    metrics = [metric for metric in ['wall_time', 'time_to_first_token', 'prompt_tokens', 'completion_tokens'] if metric in traces_df.columns]
+    stage_columns = ['agent', 'stage'] if 'agent' in traces_df.columns else ['stage']
+
+    stages_df = traces_df.groupby(on + stage_columns)[metrics].sum(min_count=1).unstack(stage_columns)
+    stages_df.columns = ['_'.join([*stage, metric]) for metric, *stage in stages_df.columns]
+    stages_df = stages_df.dropna(axis=1, how='all').reset_index()
+
+    return interactions_df.merge(stages_df, on=on, how='left')
+
+@profiled
 def compare_evaluation(evaluations_df, participants_no_interaction, compare, column, test):
     comparison_df = evaluations_df.sort_values('participant_ID')
     
@@ -493,3 +1337,290 @@ def compare_evaluation(evaluations_df, participants_no_interaction, compare, col
         'test': test(a_df, b_df)
     }
 
+# Bootstrap resamples of the mean difference of every metric (column) between a and b (rows are the paired observations if paired),
+# computed in batches of resamples to bound memory
+@profiled
+def bootstrap_mean_differences(a, b, paired, n_resamples, rng, batch_size=1000):
+    means = []
+
+    for size in np.diff(np.append(np.arange(0, n_resamples, batch_size), n_resamples)):
+        if paired:
+            rows = rng.integers(0, len(a), size=(size, len(a)))
+            means.append(np.nanmean(a[rows] - b[rows], axis=1))
+        else:
+            means.append(
+                np.nanmean(a[rng.integers(0, len(a), size=(size, len(a)))], axis=1) 
+                - np.nanmean(b[rng.integers(0, len(b), size=(size, len(b)))], axis=1)
+            )
+
+    return np.concatenate(means)
+
+# Permutation resamples of the mean difference of every metric (column) between a and b, by randomly flipping the sign of the paired differences if paired,
+# and by randomly reassigning observations to a and b otherwise
+@profiled
+def permutation_mean_differences(a, b, paired, n_resamples, rng, batch_size=1000):
+    means = []
+
+    if not paired:
+        pooled = np.concatenate([a, b])
+
+    for size in np.diff(np.append(np.arange(0, n_resamples, batch_size), n_resamples)):
+        if paired:
+            signs = rng.choice([-1, 1], size=(size, len(a), 1))
+            means.append(np.nanmean(signs * (a - b)[np.newaxis], axis=1))
+        else:
+            rows = rng.permuted(np.tile(np.arange(len(pooled)), (size, 1)), axis=1)
+            means.append(np.nanmean(pooled[rows[:, :len(a)]], axis=1) - np.nanmean(pooled[rows[:, len(a):]], axis=1))
+
+    return np.concatenate(means)
+
+# Compare metrics between two values (a, b) of a column (e.g., model or task) at once. Paired observations are matched on id_column.
+# Returns a tidy frame with a row per metric, holding the descriptive statistics per value, a Shapiro-Wilk test (of the paired differences,
+# or of the residuals per value), paired (if paired) and independent t-tests, and a bootstrap confidence interval and permutation p-value
+# of the mean difference (a - b) using n_resamples resamples
+@profiled
+def compare_metrics(
+    df, 
+    metrics, 
+    compare, 
+    values, 
+    paired=True, 
+    id_column='participant_ID', 
+    n_resamples=10000, 
+    confidence=0.95, 
+    seed=0,
+):
+    a, b = values
+    rng = np.random.default_rng(seed)
+
+    if paired:
+        wide_df = df[df[compare].isin(values)].pivot(index=id_column, columns=compare, values=metrics)
+        a_values = wide_df.xs(a, axis=1, level=1)[metrics].to_numpy(dtype=float)
+        b_values = wide_df.xs(b, axis=1, level=1)[metrics].to_numpy(dtype=float)
+    else:
+        a_values = df[df[compare] == a][metrics].to_numpy(dtype=float)
+        b_values = df[df[compare] == b][metrics].to_numpy(dtype=float)
+
+    comparison_df = pd.concat([
+        df[df[compare] == a][metrics].describe().T.add_prefix('a_'),
+        df[df[compare] == b][metrics].describe().T.add_prefix('b_'),
+    ], axis=1)
+    comparison_df.insert(0, 'b', b)
+    comparison_df.insert(0, 'a', a)
+    comparison_df.index.name = 'metric'
+
+    tests = []
+    for i in range(len(metrics)):
+        a_metric = a_values[:, i][~np.isnan(a_values[:, i])]
+        b_metric = b_values[:, i][~np.isnan(b_values[:, i])]
+
+        if paired:
+            complete = ~np.isnan(a_values[:, i]) & ~np.isnan(b_values[:, i])
+            residuals = a_values[complete, i] - b_values[complete, i]
+            ttest_rel = stats.ttest_rel(a_values[complete, i], b_values[complete, i])
+        else:
+            residuals = np.concatenate([a_metric - a_metric.mean(), b_metric - b_metric.mean()])
+            ttest_rel = None
+
+        shapiro = stats.shapiro(residuals) if len(residuals) >= 3 else None
+        ttest_ind = stats.ttest_ind(a_metric, b_metric)
+
+        tests.append({
+            'shapiro_statistic': shapiro.statistic if shapiro is not None else np.nan,
+            'shapiro_pvalue': shapiro.pvalue if shapiro is not None else np.nan,
+            'ttest_rel_statistic': ttest_rel.statistic if ttest_rel is not None else np.nan,
+            'ttest_rel_pvalue': ttest_rel.pvalue if ttest_rel is not None else np.nan,
+            'ttest_ind_statistic': ttest_ind.statistic,
+            'ttest_ind_pvalue': ttest_ind.pvalue,
+        })
+
+    # Resample all metrics at once
+    with np.errstate(invalid='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+
+        if paired:
+            mean_difference = np.nanmean(a_values - b_values, axis=0)
+        else:
+            mean_difference = np.nanmean(a_values, axis=0) - np.nanmean(b_values, axis=0)
+
+        bootstrap = bootstrap_mean_differences(a_values, b_values, paired, n_resamples, rng)
+        permutation = permutation_mean_differences(a_values, b_values, paired, n_resamples, rng)
+
+        ci_low, ci_high = np.nanpercentile(bootstrap, [(1 - confidence) / 2 * 100, (1 + confidence) / 2 * 100], axis=0)
+        permutation_pvalue = ((np.abs(permutation) >= np.abs(mean_difference) - 1e-12).sum(axis=0) + 1) / (n_resamples + 1)
+
+    comparison_df = pd.concat([comparison_df, pd.DataFrame(tests, index=comparison_df.index)], axis=1)
+    comparison_df['mean_difference'] = mean_difference
+    comparison_df['ci_low'] = ci_low
+    comparison_df['ci_high'] = ci_high
+    comparison_df['permutation_pvalue'] = permutation_pvalue
+    comparison_df['n_resamples'] = n_resamples
+
+    return comparison_df.reset_index()
+
+# Load the scores of the LLM-as-judge evaluation (see agent.ajudge_turns), one row per turn, criterion and model
+@profiled
+def load_judge_scores(file='data/judge-scores.csv'):
+    return pd.read_csv(file, dtype={'conversation': str, 'snippet': str, 'judge': str, 'criterion': str, 'model': str, 'position': str})
+
+# Aggregate the judge scores per criterion (and the given columns, e.g., snippet): the mean score of every model, and how often the ToM response
+# scored higher than (wins), equal to (ties) or lower than (losses) the control response of the same turn
+@profiled
+def aggregate_judge_scores(scores_df, by=[]):
+    pairs_df = scores_df.pivot_table(
+        index=['judge', 'conversation', 'snippet', 'turn', 'criterion'],
+        columns='model',
+        values='score',
+    ).reset_index()
+    pairs_df['difference'] = pairs_df['tom'] - pairs_df['control']
+
+    return pairs_df.groupby(['criterion'] + by).agg(
+        n=('difference', 'count'),
+        control_mean=('control', 'mean'),
+        tom_mean=('tom', 'mean'),
+        tom_wins=('difference', lambda difference: (difference > 0).mean()),
+        ties=('difference', lambda difference: (difference == 0).mean()),
+        tom_losses=('difference', lambda difference: (difference < 0).mean()),
+    ).reset_index()
+
+# Compare the judge scores of the control and ToM responses on all criteria at once, paired per turn, with compare_metrics
+@profiled
+def compare_judge_scores(scores_df, **options):
+    wide_df = scores_df.pivot_table(
+        index=['judge', 'conversation', 'turn', 'model'],
+        columns='criterion',
+        values='score',
+    ).reset_index()
+    wide_df['turn_ID'] = wide_df['judge'] + ':' + wide_df['conversation'] + ':' + wide_df['turn'].astype(str)
+
+    return compare_metrics(wide_df, list(scores_df['criterion'].unique()), 'model', ['control', 'tom'], paired=True, id_column='turn_ID', **options)
+
+# Design of the specification curve, shared with its worker processes
+specification_curve_design = None
+
+# Enumerate the specifications of a regression of each outcome (in each of its families) on the treatment: one per combination of covariates,
+# where every slot of covariates lists alternatives (None to leave the slot out), covariance type, and named participant filter (see specification_design)
+@profiled
+def enumerate_specifications(outcomes, treatment, covariates, cov_types=['nonrobust'], filters={'all': None}):
+    return [
+        {
+            'outcome': outcome,
+            'family': family,
+            'treatment': treatment,
+            'covariates': [covariate for covariate in slots if covariate is not None],
+            'cov_type': cov_type,
+            'filter': filter,
+        }
+        for outcome, families in outcomes.items()
+        for family in families
+        for slots in itertools.product(*covariates)
+        for cov_type in cov_types
+        for filter in filters
+    ]
+
+# Build the design shared by all specifications once: the outcomes, treatment and covariates as float arrays, and a row mask per named filter (a query, None for all rows)
+@profiled
+def specification_design(df, specifications, filters={'all': None}):
+    columns = list(dict.fromkeys(
+        column
+        for specification in specifications
+        for column in [specification['treatment'], *specification['covariates']]
+    ))
+    outcomes = list(dict.fromkeys(specification['outcome'] for specification in specifications))
+
+    return {
+        'columns': columns,
+        'X': df[columns].astype(float).to_numpy(),
+        'y': {outcome: df[outcome].astype(float).to_numpy() for outcome in outcomes},
+        'masks': {
+            name: np.ones(len(df), dtype=bool) if query is None else df.eval(query).to_numpy(dtype=bool)
+            for name, query in filters.items()
+        },
+    }
+
+# Use the shared design in a worker process
+@profiled
+def init_specification_worker(design):
+    global specification_curve_design
+    specification_curve_design = design
+
+# Fit a single specification on the shared design (complete cases only). Returns a row per term with its coefficient, standard error, p-value,
+# confidence interval and variance inflation factor, or a single row with the reason the specification could not be fitted
+@profiled
+def fit_specification(specification, confidence=0.95):
+    import statsmodels.api as sm
+
+    families = {
+        'poisson': sm.families.Poisson, 
+        'gaussian': sm.families.Gaussian, 
+        'negative_binomial': sm.families.NegativeBinomial,
+    }
+    design = specification_curve_design
+    terms = [specification['treatment'], *specification['covariates']]
+    X = design['X'][:, [design['columns'].index(term) for term in terms]]
+    y = design['y'][specification['outcome']]
+
+    rows = design['masks'][specification['filter']] & ~np.isnan(y) & ~np.isnan(X).any(axis=1)
+    X = X[rows]
+    y = y[rows]
+
+    specification_row = {
+        **specification,
+        'covariates': ' + '.join(specification['covariates']),
+        'formula': f"{specification['outcome']} ~ {' + '.join(terms)}",
+        'n': len(y),
+    }
+
+    # Terms without variation (e.g., the filtered column) cannot be estimated
+    constant = [term for term, values in zip(terms, X.T) if len(values) == 0 or (values == values[0]).all()]
+    if len(constant) > 0:
+        return [{**specification_row, 'status': f"constant {', '.join(constant)}"}]
+    if len(y) <= len(terms) + 1:
+        return [{**specification_row, 'status': 'too few observations'}]
+
+    # Variance inflation factors, as variance_inflation_factor with a constant
+    vifs = np.diag(np.linalg.pinv(np.atleast_2d(np.corrcoef(X, rowvar=False)))) if len(terms) > 1 else np.ones(1)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        result = sm.GLM(y, sm.add_constant(X, has_constant='add'), family=families[specification['family']]()).fit(cov_type=specification['cov_type'])
+        ci = result.conf_int(1 - confidence)
+
+    return [
+        {
+            **specification_row,
+            'term': term,
+            'coef': result.params[i],
+            'se': result.bse[i],
+            'pvalue': result.pvalues[i],
+            'ci_low': ci[i, 0],
+            'ci_high': ci[i, 1],
+            'vif': vifs[i - 1] if i > 0 else np.nan,
+            'dispersion': result.pearson_chi2 / result.df_resid,
+            'aic': result.aic,
+            'converged': result.converged,
+            'status': 'fitted',
+        }
+        for i, term in enumerate(['Intercept', *terms])
+    ]
+
+# Fit all specifications of a specification curve (see enumerate_specifications) in a process pool, with the design built once and shared with the workers.
+# Returns a tidy table with a row per specification and term (a single row without a term for specifications that could not be fitted)
+@profiled
+def specification_curve(df, specifications, filters={'all': None}, confidence=0.95, processes=None, chunksize=None):
+    design = specification_design(df, specifications, filters)
+    fit = functools.partial(fit_specification, confidence=confidence)
+
+    if processes == 1:
+        init_specification_worker(design)
+        results = list(map(fit, specifications))
+    else:
+        chunksize = chunksize or max(1, len(specifications) // ((processes or os.cpu_count() or 1) * 4))
+        with concurrent.futures.ProcessPoolExecutor(processes, initializer=init_specification_worker, initargs=(design,)) as executor:
+            results = list(executor.map(fit, specifications, chunksize=chunksize))
+
+    return pd.DataFrame([
+        {'specification': i, **row}
+        for i, rows in enumerate(results)
+        for row in rows
+    ])
@@ -0,0 +1,234 @@
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+
+# Companion to /task/snippets/data-analysis.py (see its license), for autos.csv files of any size: the outliers are filtered with a grouped transform
+# for any set of vehicle types, the average price per brand and vehicle type is computed with a single groupby, and the cleaned data is not read back.
+# Files too large for memory are processed in chunks
+
+# The vehicle types filtered in the snippet
+snippet_vehicle_types = ['andere', 'Other', 'suv', 'kombi', 'bus', 'cabrio', 'limousine', 'coupe', 'kleinwagen']
+offer_types = {'Gesuch': 'Request', 'Angebot': 'Offer'}
+fuel_types = {'benzin': 'Gasoline', 'diesel': 'Diesel', 'other': 'Other', 'lpg': 'Lpg', 'hybrid': 'Hybrid', 'cng': 'Cng', 'elektro': 'Electric'}
+outlier_columns = ['vehicleType', 'yearOfRegistration', 'price']
+
+# Fill in the vehicle type, translate the offer type, and keep the years of registration from 1890 to 2016
+def prepare(df):
+    df = df.copy()
+    df['vehicleType'] = df['vehicleType'].fillna('Other')
+    if 'offerType' in df.columns:
+        df['offerType'] = df['offerType'].map(offer_types)
+
+    return df[(df['yearOfRegistration'] >= 1890) & (df['yearOfRegistration'] <= 2016)]
+
+# Keep the cars with a price up to 1.5 IQR above the median price of their vehicle type, of the given vehicle types (default: all), and translate the fuel type
+def filter_outliers(df, thresholds, vehicle_types=None):
+    keep = df['price'] <= thresholds
+    if vehicle_types is not None:
+        keep &= df['vehicleType'].isin(vehicle_types)
+
+    df = df[keep].copy()
+    df['fuelType'] = df['fuelType'].fillna('other').map(fuel_types)
+    return df
+
+# Quantile of the values with the given counts (sorted by value), linearly interpolated between the closest values as by pandas
+def counts_quantile(values, counts, q):
+    cumulative_counts = np.cumsum(counts)
+    position = (cumulative_counts[-1] - 1) * q
+    lower = int(np.floor(position))
+    lower_value, upper_value = values[np.searchsorted(cumulative_counts, [lower, min(lower + 1, cumulative_counts[-1] - 1)], side='right')]
+
+    return lower_value + (upper_value - lower_value) * (position - lower)
+
+# Price threshold per vehicle type: 1.5 IQR above the median, from the number of cars of every price per vehicle type
+def price_thresholds(price_counts):
+    thresholds = {}
+    for vehicle_type, counts in price_counts.groupby(level='vehicleType', sort=False):
+        prices = counts.index.get_level_values('price').to_numpy()
+        counts = counts.to_numpy()
+        quantiles = [counts_quantile(prices, counts, q) for q in [0.25, 0.5, 0.75]]
+        thresholds[vehicle_type] = (quantiles[2] - quantiles[0]) * 1.5 + quantiles[1]
+
+    return pd.Series(thresholds, dtype=float)
+
+# The cleaned data of the snippet
+def clean(df, vehicle_types=None):
+    df = prepare(df)
+    grouped = df.groupby('vehicleType')['price']
+    thresholds = (grouped.transform('quantile', 0.75) - grouped.transform('quantile', 0.25)) * 1.5 + grouped.transform('median')
+
+    return filter_outliers(df, thresholds, vehicle_types)
+
+# Average price per brand (rows) and vehicle type (columns), truncated to integers, and 0 for combinations without cars, as in the snippet.
+# Prices are summed and counted per group, so the averages of chunks can be combined
+def average_prices(sums, counts):
+    averages = (sums / counts).unstack('vehicleType')
+    averages = averages.reindex(index=averages.index.sort_values(), columns=averages.columns.sort_values())
+
+    return averages.fillna(0).astype(int)
+
+# Sum and count the prices per brand and vehicle type
+def price_sums(df):
+    grouped = df.groupby(['brand', 'vehicleType'])['price']
+    return grouped.sum(), grouped.count()
+
+# Clean the autos.csv file and compute the average prices, optionally writing the cleaned data to clean_data_path.
+# With a chunksize, the file is read in two passes of chunks: one over the vehicle types, years and prices only to count the cars of every price
+# per vehicle type, from which the price thresholds are found, and one to filter the outliers and sum the prices, so that only the counts of the
+# distinct prices (and not the full data) are kept in memory
+def clean_autos(raw_data_path, clean_data_path=None, vehicle_types=None, chunksize=None):
+    if chunksize is None:
+        df = clean(pd.read_csv(raw_data_path, encoding='latin-1'), vehicle_types)
+        if clean_data_path is not None:
+            df.to_csv(clean_data_path, index=False)
+        return average_prices(*price_sums(df))
+
+    price_counts = pd.Series(dtype=np.int64)
+    for chunk_df in pd.read_csv(raw_data_path, encoding='latin-1', usecols=outlier_columns, chunksize=chunksize):
+        chunk_counts = prepare(chunk_df).groupby(['vehicleType', 'price']).size()
+        price_counts = chunk_counts if len(price_counts) == 0 else price_counts.add(chunk_counts, fill_value=0)
+    thresholds = price_thresholds(price_counts.sort_index().astype(np.int64))
+
+    sums = []
+    counts = []
+    for i, chunk_df in enumerate(pd.read_csv(raw_data_path, encoding='latin-1', chunksize=chunksize)):
+        chunk_df = prepare(chunk_df)
+        chunk_df = filter_outliers(chunk_df, chunk_df['vehicleType'].map(thresholds), vehicle_types)
+        if clean_data_path is not None:
+            chunk_df.to_csv(clean_data_path, index=False, mode='w' if i == 0 else 'a', header=i == 0)
+
+        chunk_sums, chunk_counts = price_sums(chunk_df)
+        sums.append(chunk_sums)
+        counts.append(chunk_counts)
+
+    return average_prices(pd.concat(sums).groupby(level=[0, 1]).sum(), pd.concat(counts).groupby(level=[0, 1]).sum())
+
+# The average prices of the snippet, without the heatmap
+def original_average_prices(raw_data_path, clean_data_path):
+    df = pd.read_csv(raw_data_path,encoding="latin-1")
+
+    df["vehicleType"] = df["vehicleType"].fillna("Other")
+    df["offerType"] = df["offerType"].map({'Gesuch':"Request",'Angebot':'Offer'})
+
+    df = df[(df["yearOfRegistration"] >= 1890) & (df["yearOfRegistration"] <= 2016)]
+
+    _median = df.groupby("vehicleType")["price"].median()
+    _quantile75 = df.groupby("vehicleType")["price"].quantile(0.75)
+    _quantile25 = df.groupby("vehicleType")["price"].quantile(0.25)
+    iqr = (_quantile75 - _quantile25)*1.5 + _median
+
+    df = df[((df["vehicleType"] == "andere") & (df["price"] <= iqr["andere"])) |
+            ((df["vehicleType"] == "Other") & (df["price"] <= iqr["Other"])) |
+            ((df["vehicleType"] == "suv") & (df["price"] <= iqr["suv"])) |
+            ((df["vehicleType"] == "kombi") & (df["price"] <= iqr["kombi"])) |
+            ((df["vehicleType"] == "bus") & (df["price"] <= iqr["bus"])) |
+            ((df["vehicleType"] == "cabrio") & (df["price"] <= iqr["cabrio"])) |
+            ((df["vehicleType"] == "limousine") & (df["price"] <= iqr["limousine"])) |
+            ((df["vehicleType"] == "coupe") & (df["price"] <= iqr["coupe"])) |
+            ((df["vehicleType"] == "kleinwagen") & (df["price"] <= iqr["kleinwagen"]))]
+
+    df["fuelType"] = df["fuelType"].fillna("other")
+    df["fuelType"] = df["fuelType"].map({'benzin':'Gasoline','diesel':'Diesel','other':'Other','lpg':'Lpg','hybrid':'Hybrid','cng':'Cng','elektro':'Electric'})
+
+    df.to_csv(clean_data_path,index=False)
+
+    df = pd.read_csv(clean_data_path,encoding="latin-1")
+
+    trial = pd.DataFrame()
+    for b in list(df["brand"].unique()):
+        for v in list(df["vehicleType"].unique()):
+            z = df[(df["brand"] == b) & (df["vehicleType"] == v)]["price"].mean()
+            trial = pd.concat([trial, pd.DataFrame([{'brand':b , 'vehicleType':v , 'avgPrice':z}])], ignore_index=True)
+    trial["avgPrice"] = trial["avgPrice"].fillna(0)
+    trial["avgPrice"] = trial["avgPrice"].astype(int)
+
+    return trial.pivot(index="brand",columns="vehicleType", values="avgPrice")
+
+# Generate a synthetic autos.csv file in the format of the used cars dataset the snippet was written for, with missing vehicle and fuel types,
+# invalid years of registration, and price outliers
+def generate_autos(path, n_rows, n_brands=40, seed=0):
+    rng = np.random.default_rng(seed)
+    vehicle_type_values = np.array([vehicle_type for vehicle_type in snippet_vehicle_types if vehicle_type != 'Other'] + [None], dtype=object)
+    fuel_type_values = np.array(list(fuel_types) + [None], dtype=object)
+    brands = np.array([f'brand_{i}' for i in range(n_brands)])
+
+    price = np.round(rng.lognormal(8.5, 1, size=n_rows)).astype(int)
+    outliers = rng.random(n_rows) < 0.01
+    price[outliers] = rng.integers(100000, 100000000, size=outliers.sum())
+
+    autos_df = pd.DataFrame({
+        'dateCrawled': '2016-03-24 11:52:17',
+        'name': [f'car_{i}' for i in range(n_rows)],
+        'seller': 'privat',
+        'offerType': rng.choice(['Angebot', 'Gesuch'], size=n_rows, p=[0.99, 0.01]),
+        'price': price,
+        'abtest': rng.choice(['test', 'control'], size=n_rows),
+        'vehicleType': rng.choice(vehicle_type_values, size=n_rows, p=[0.01, 0.04, 0.18, 0.08, 0.06, 0.25, 0.05, 0.23, 0.10]),
+        'yearOfRegistration': np.where(rng.random(n_rows) < 0.01, rng.integers(1000, 9999, size=n_rows), rng.integers(1950, 2019, size=n_rows)),
+        'gearbox': rng.choice(['manuell', 'automatik'], size=n_rows),
+        'powerPS': rng.integers(0, 500, size=n_rows),
+        'model': rng.choice(['golf', 'andere', '3er', 'polo'], size=n_rows),
+        'kilometer': rng.choice([5000, 50000, 100000, 150000], size=n_rows),
+        'monthOfRegistration': rng.integers(0, 13, size=n_rows),
+        'fuelType': rng.choice(fuel_type_values, size=n_rows, p=[0.6, 0.28, 0.02, 0.01, 0.01, 0.01, 0.01, 0.06]),
+        # Rare brands do not have cars of every vehicle type
+        'brand': brands[np.minimum(rng.zipf(1.5, size=n_rows), n_brands) - 1],
+        'notRepairedDamage': rng.choice(['nein', 'ja', None], size=n_rows),
+        'dateCreated': '2016-03-24 00:00:00',
+        'nrOfPictures': 0,
+        'postalCode': rng.integers(1000, 99999, size=n_rows),
+        'lastSeen': '2016-04-07 03:16:57',
+    })
+    autos_df.to_csv(path, index=False, encoding='latin-1')
+
+# Time the snippet and the companion (in memory and in chunks) on synthetic autos.csv files, and check that their average prices are identical
+def benchmark(scales, chunksize=100000, seed=0):
+    results = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        for n_rows in scales:
+            raw_data_path = os.path.join(directory, 'autos.csv')
+            generate_autos(raw_data_path, n_rows, seed=seed)
+
+            times = {}
+            averages = {}
+            for method, average in [
+                ('original', lambda: original_average_prices(raw_data_path, os.path.join(directory, 'cleaned_autos.csv'))),
+                ('in_memory', lambda: clean_autos(raw_data_path, vehicle_types=snippet_vehicle_types)),
+                ('chunked', lambda: clean_autos(raw_data_path, vehicle_types=snippet_vehicle_types, chunksize=chunksize)),
+            ]:
+                time_start = time.perf_counter()
+                averages[method] = average()
+                times[method] = time.perf_counter() - time_start
+
+            identical = {
+                method: averages[method].equals(averages['original'])
+                and list(averages[method].index) == list(averages['original'].index)
+                and list(averages[method].columns) == list(averages['original'].columns)
+                for method in ['in_memory', 'chunked']
+            }
+            results.append({'n_rows': n_rows, **{f'{method}_time': method_time for method, method_time in times.items()}, **{f'{method}_identical': method_identical for method, method_identical in identical.items()}})
+            print(
+                f"{n_rows:>8} rows: original {times['original']:.3f}s, "
+                f"in memory {times['in_memory']:.3f}s ({times['original'] / times['in_memory']:.0f}x, identical: {identical['in_memory']}), "
+                f"chunked {times['chunked']:.3f}s ({times['original'] / times['chunked']:.0f}x, identical: {identical['chunked']})"
+            )
+
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compute the average price per brand and vehicle type of an autos.csv file, or benchmark against the snippet on synthetic data.')
+    parser.add_argument('raw_data_path', nargs='?', default=os.path.join('..', 'data', 'autos.csv'))
+    parser.add_argument('--clean-data-path', default=None)
+    parser.add_argument('--chunksize', type=int, default=None)
+    parser.add_argument('--benchmark', type=int, nargs='*', default=None, help='numbers of synthetic rows (default: 10000 100000 1000000)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.benchmark is not None:
+        benchmark(args.benchmark or [10000, 100000, 1000000], args.chunksize or 100000, args.seed)
+    else:
+        print(clean_autos(args.raw_data_path, args.clean_data_path, chunksize=args.chunksize).to_string())
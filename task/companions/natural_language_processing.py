@@ -0,0 +1,135 @@
+import argparse
+import os
+import time
+import numpy as np
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.preprocessing import normalize
+
+# Companion to /task/snippets/natural-language-processing.py (see its license), for screening thousands of documents:
+# the TF-IDF matrix is kept sparse, and the similarities are computed per block of rows with a single sparse matrix product,
+# for every pair only once. Only the pairs above the threshold are emitted
+
+# Read the names and texts of the .txt documents in a directory, as in the snippet
+def load_documents(directory='.'):
+    names = [doc for doc in os.listdir(directory) if doc.endswith('.txt')]
+    texts = []
+    for name in names:
+        with open(os.path.join(directory, name), encoding='utf-8') as file:
+            texts.append(file.read())
+
+    return names, texts
+
+# Sparse TF-IDF vectors of the documents
+def vectorize(texts):
+    return TfidfVectorizer().fit_transform(texts)
+
+# Emit the (name_a, name_b, similarity) of every pair of documents with a cosine similarity above the threshold, with the names sorted as in the snippet.
+# Rows are processed in blocks of block_size, which bounds the memory to a block_size x n similarity block
+def iter_similar_pairs(names, vectors, threshold=0.9, block_size=500):
+    vectors = normalize(sp.csr_matrix(vectors))
+    names = np.asarray(names, dtype=object)
+
+    for start in range(0, vectors.shape[0], block_size):
+        # Similarities of the block with the documents from the block onwards, i.e., the upper triangle
+        block = (vectors[start:start + block_size] @ vectors[start:].T).tocoo()
+        rows = block.row + start
+        columns = block.col + start
+        above = (columns > rows) & (block.data > threshold)
+
+        for a, b, similarity in zip(names[rows[above]], names[columns[above]], block.data[above]):
+            yield (a, b, similarity) if a <= b else (b, a, similarity)
+
+# The set of pairs of documents in a directory with a cosine similarity above the threshold
+def similar_documents(directory='.', threshold=0.9, block_size=500):
+    names, texts = load_documents(directory)
+    return set(iter_similar_pairs(names, vectorize(texts), threshold, block_size))
+
+# The comparisons of the snippet, i.e., (name_a, name_b, similarity, match) for every pair (in both orders)
+def original_comparisons(student_files, student_texts, threshold=0.9):
+    def vectorize(Text):
+        return TfidfVectorizer().fit_transform(Text).toarray()
+
+    vectors = vectorize(student_texts)
+
+    def similarity(doc1, doc2):
+        return cosine_similarity([doc1, doc2])
+
+    s_vectors = list(zip(student_files, vectors))
+    comparisons = set()
+
+    for student_a, text_vector_a in s_vectors:
+        new_vectors = s_vectors.copy()
+
+        current_index = new_vectors.index((student_a, text_vector_a))
+        del new_vectors[current_index]
+
+        for student_b, text_vector_b in new_vectors:
+            sim_score = similarity(text_vector_a, text_vector_b)[0][1]
+            student_pair = sorted((student_a, student_b))
+            match = sim_score > threshold
+            comparison = (*student_pair, sim_score, match)
+            comparisons.add(comparison)
+
+    return comparisons
+
+# Synthetic student documents with Zipf-distributed words, of which a fraction plagiarizes another document with a few words replaced
+def generate_documents(n_documents, n_words=200, vocabulary_size=5000, plagiarized=0.05, replaced=0.02, seed=0):
+    rng = np.random.default_rng(seed)
+    vocabulary = np.array([f'word{i}' for i in range(vocabulary_size)])
+    words = vocabulary[np.minimum(rng.zipf(1.3, size=(n_documents, n_words)), vocabulary_size) - 1]
+
+    for i in np.flatnonzero(rng.random(n_documents) < plagiarized):
+        source = rng.integers(0, n_documents)
+        words[i] = words[source]
+        replace = rng.random(n_words) < replaced
+        words[i, replace] = vocabulary[rng.integers(0, vocabulary_size, size=replace.sum())]
+
+    names = [f'student_{i}.txt' for i in range(n_documents)]
+    texts = [' '.join(document) for document in words]
+    return names, texts
+
+# Time the snippet and the blocked similarities on synthetic documents, and check that they find the same pairs.
+# The snippet takes O(n^2) Python calls, and is only run up to original_max documents
+def benchmark(scales, threshold=0.9, block_size=500, original_max=1000, seed=0):
+    results = []
+
+    for n_documents in scales:
+        names, texts = generate_documents(n_documents, seed=seed)
+
+        time_start = time.perf_counter()
+        pairs = set(iter_similar_pairs(names, vectorize(texts), threshold, block_size))
+        blocked_time = time.perf_counter() - time_start
+
+        result = {'n_documents': n_documents, 'n_pairs': len(pairs), 'blocked_time': blocked_time, 'original_time': None, 'identical': None}
+
+        if n_documents <= original_max:
+            time_start = time.perf_counter()
+            comparisons = original_comparisons(names, texts, threshold)
+            result['original_time'] = time.perf_counter() - time_start
+            result['identical'] = {(a, b) for a, b, _, match in comparisons if match} == {(a, b) for a, b, _ in pairs}
+
+        results.append(result)
+        print(
+            f"{n_documents:>6} documents: {len(pairs)} pairs, blocked {blocked_time:.3f}s"
+            + (f", original {result['original_time']:.3f}s ({result['original_time'] / blocked_time:.0f}x), identical: {result['identical']}" if result['original_time'] is not None else ', original skipped')
+        )
+
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Find the pairs of similar .txt documents in a directory, or benchmark against the snippet on synthetic documents.')
+    parser.add_argument('directory', nargs='?', default='.')
+    parser.add_argument('--threshold', type=float, default=0.9)
+    parser.add_argument('--block-size', type=int, default=500)
+    parser.add_argument('--benchmark', type=int, nargs='*', default=None, help='numbers of synthetic documents (default: 100 1000 10000)')
+    parser.add_argument('--original-max', type=int, default=1000, help='largest number of documents to run the snippet on')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.benchmark is not None:
+        benchmark(args.benchmark or [100, 1000, 10000], args.threshold, args.block_size, args.original_max, args.seed)
+    else:
+        for pair in sorted(similar_documents(args.directory, args.threshold, args.block_size)):
+            print(*pair)
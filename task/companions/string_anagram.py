@@ -0,0 +1,202 @@
+import argparse
+import importlib.util
+import itertools
+import os
+import random
+import time
+import numpy as np
+
+# Companion to /task/snippets/string-anagram.py (see its license), for checking millions of pairs and grouping large word lists.
+# Strings are normalized as in the snippet, and compared by their signature: their code points, sorted. Strings of the same length
+# are processed together as a fixed-width matrix of code points, sorted per row with numpy
+
+# The function of the snippet
+def load_snippet_function(path=os.path.join(os.path.dirname(__file__), '..', 'snippets', 'string-anagram.py')):
+    spec = importlib.util.spec_from_file_location('string_anagram_snippet', path)
+    snippet = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(snippet)
+    return snippet.xxxxx
+
+# Lowercase, strip, and remove the spaces of a string, as in the snippet
+def normalize(string):
+    return string.lower().strip().replace(' ', '')
+
+# The sorted code points of strings that all have the given length, as a (strings x length) matrix
+def sorted_code_points(strings, length):
+    width = max(length, 1)
+    matrix = np.array(strings, dtype=f'U{width}').view(np.uint32).reshape(len(strings), width)
+    return np.sort(matrix, axis=1)[:, width - length:]
+
+# Indices of (normalized) strings per length
+def length_groups(lengths):
+    order = np.argsort(lengths, kind='stable')
+    boundaries = np.flatnonzero(np.diff(lengths[order])) + 1
+    return np.split(order, boundaries)
+
+# Iterate over batches of an iterable
+def batches(iterable, batch_size):
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, batch_size)):
+        yield batch
+
+# Whether the strings of every pair are anagrams, for an iterable of (first, second) pairs.
+# Only the pairs of strings of equal (normalized) length are compared, per batch of batch_size pairs
+def are_anagrams(pairs, batch_size=100000):
+    results = []
+
+    for batch in batches(pairs, batch_size):
+        first = [normalize(first_string) for first_string, _ in batch]
+        second = [normalize(second_string) for _, second_string in batch]
+        lengths = np.fromiter(map(len, first), dtype=np.int64, count=len(batch))
+        result = lengths == np.fromiter(map(len, second), dtype=np.int64, count=len(batch))
+
+        candidates = np.flatnonzero(result)
+        for group in length_groups(lengths[candidates]):
+            if len(group) == 0:
+                continue
+
+            indices = candidates[group]
+            length = lengths[indices[0]]
+            result[indices] = (
+                sorted_code_points([first[i] for i in indices], length) == sorted_code_points([second[i] for i in indices], length)
+            ).all(axis=1)
+
+        results.append(result)
+
+    return np.concatenate(results) if len(results) > 0 else np.zeros(0, dtype=bool)
+
+# Signatures of strings, which are equal for (and only for) anagrams
+def signatures(strings):
+    normalized = [normalize(string) for string in strings]
+    lengths = np.fromiter(map(len, normalized), dtype=np.int64, count=len(normalized))
+    result = [None] * len(normalized)
+
+    for group in length_groups(lengths):
+        if len(group) == 0:
+            continue
+
+        for i, code_points in zip(group, sorted_code_points([normalized[i] for i in group], lengths[group[0]])):
+            result[i] = code_points.tobytes()
+
+    return result
+
+# Group the words of an iterable (e.g., a file read line by line) into anagrams, processed in batches of batch_size words.
+# Returns the groups of at least min_size words, in order of their first word
+def group_anagrams(words, batch_size=100000, min_size=1):
+    groups = {}
+
+    for batch in batches(words, batch_size):
+        for signature, word in zip(signatures(batch), batch):
+            groups.setdefault(signature, []).append(word)
+
+    return [group for group in groups.values() if len(group) >= min_size]
+
+# Random strings to compare with the snippet: mixed case, (non-ASCII) letters whose lowercase differs in length, spaces and other whitespace
+alphabet = ['a', 'b', 'c', 'A', 'B', 'C', 'é', 'É', 'ß', 'İ', 'ſ', ' ', ' ', '\t', '\n', '\x00', '1', '😀']
+
+def random_string(rng, max_length=8):
+    return ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, max_length)))
+
+# Rearrange a string into a likely anagram: shuffled, with random case and spaces
+def rearrange(rng, string):
+    characters = list(string)
+    rng.shuffle(characters)
+    characters = [character.upper() if rng.random() < 0.3 else character for character in characters]
+    for _ in range(rng.randint(0, 2)):
+        characters.insert(rng.randint(0, len(characters)), ' ')
+    return ''.join(characters)
+
+# Pairs of random strings and (near-)anagrams of them, with the properties the snippet normalizes: case, spaces, and leading and trailing whitespace
+def agreement_corpus(n_pairs, seed=0):
+    rng = random.Random(seed)
+    pairs = []
+
+    for _ in range(n_pairs):
+        first = random_string(rng)
+        kind = rng.randrange(4)
+        if kind == 0:
+            second = random_string(rng)
+        elif kind == 1:
+            second = rearrange(rng, first)
+        elif kind == 2:
+            second = rearrange(rng, first)
+            if len(second) > 0:
+                i = rng.randrange(len(second))
+                second = second[:i] + rng.choice(alphabet) + second[i + 1:]
+        else:
+            second = rng.choice(['', ' ', '\t', '\n']) + rearrange(rng, first) + rng.choice(['', ' ', '\t', '\n'])
+        pairs.append((first, second))
+
+    return pairs
+
+# Check that are_anagrams and group_anagrams agree with the snippet on the corpus. Returns the pairs they disagree on
+def check_agreement(n_pairs=100000, seed=0):
+    xxxxx = load_snippet_function()
+    pairs = agreement_corpus(n_pairs, seed)
+    expected = np.array([xxxxx(first, second) for first, second in pairs])
+
+    disagreements = [pair for pair, agrees in zip(pairs, are_anagrams(pairs, batch_size=997) == expected) if not agrees]
+
+    # Two strings are in the same group if and only if they are anagrams
+    group_ids = {}
+    for group_id, group in enumerate(group_anagrams([string for pair in pairs for string in pair], batch_size=997)):
+        for string in group:
+            group_ids[string] = group_id
+    disagreements += [pair for pair, is_anagram in zip(pairs, expected) if (group_ids[pair[0]] == group_ids[pair[1]]) != is_anagram]
+
+    return disagreements
+
+# Time the snippet and are_anagrams on pairs of random words, and group_anagrams on the words
+def benchmark(scales, seed=0):
+    xxxxx = load_snippet_function()
+    rng = random.Random(seed)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    vocabulary = [''.join(rng.choice(letters) for _ in range(rng.randint(3, 10))) for _ in range(10000)]
+    vocabulary += [rearrange(rng, word) for word in vocabulary]
+
+    results = []
+    for n_pairs in scales:
+        # Half of the pairs are candidate anagrams of equal length, for which the snippet cannot return early
+        pairs = [(word, rearrange(rng, word) if rng.random() < 0.5 else rng.choice(vocabulary)) for word in rng.choices(vocabulary, k=n_pairs)]
+
+        time_start = time.perf_counter()
+        expected = [xxxxx(first, second) for first, second in pairs]
+        original_time = time.perf_counter() - time_start
+
+        time_start = time.perf_counter()
+        result = are_anagrams(pairs)
+        bulk_time = time.perf_counter() - time_start
+
+        words = [word for pair in pairs for word in pair]
+        time_start = time.perf_counter()
+        groups = group_anagrams(words, min_size=2)
+        group_time = time.perf_counter() - time_start
+
+        identical = result.tolist() == expected
+        results.append({'n_pairs': n_pairs, 'original_time': original_time, 'bulk_time': bulk_time, 'identical': identical, 'n_words': len(words), 'group_time': group_time, 'n_groups': len(groups)})
+        print(f'{n_pairs:>8} pairs: original {original_time:.3f}s, bulk {bulk_time:.3f}s ({original_time / bulk_time:.0f}x, identical: {identical}), grouped {len(words)} words in {group_time:.3f}s')
+
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Group the words of a file (one per line) into anagrams, check the agreement with the snippet, or benchmark against the snippet.')
+    parser.add_argument('words_file', nargs='?', default=None)
+    parser.add_argument('--min-size', type=int, default=2)
+    parser.add_argument('--check', type=int, default=None, help='number of random pairs to check the agreement with the snippet on')
+    parser.add_argument('--benchmark', type=int, nargs='*', default=None, help='numbers of random pairs (default: 10000 100000 1000000)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.check is not None:
+        disagreements = check_agreement(args.check, args.seed)
+        print(f'{len(disagreements)} disagreements on {args.check} pairs')
+        for pair in disagreements[:10]:
+            print(repr(pair))
+    elif args.benchmark is not None:
+        benchmark(args.benchmark or [10000, 100000, 1000000], args.seed)
+    elif args.words_file is not None:
+        with open(args.words_file, encoding='utf-8') as file:
+            for group in group_anagrams((line.rstrip('\n') for line in file), min_size=args.min_size):
+                print(' '.join(group))
+    else:
+        parser.print_help()
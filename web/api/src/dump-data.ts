@@ -31,6 +31,8 @@ import prisma from './plugins/prisma';
                     order: true,
                     content: true,
                     type: true,
+                    tokenCountInput: true,
+                    tokenCountOutput: true,
                     timeMS: true,
                 },
             },